@@ -0,0 +1,327 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# asyncio transport for HMTL serial and TCP links
+#
+################################################################################
+
+import asyncio
+from collections import deque
+import os
+import time
+
+import serial
+
+from hmtl.FrameParser import FrameParser
+from hmtl.HMTLSerial import HMTLConfigException
+from hmtl.InputBuffer import InputItem
+from hmtl.LinkMetrics import LinkMetrics
+from hmtl.TimedLogger import TimedLogger
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+class AsyncLink(asyncio.Protocol):
+    """
+    This class is the asyncio equivalent of an InputBuffer combined with
+    HMTLSerial.  Received data is split into InputItems exactly as with the
+    threaded buffers, and those items are available either through get() or
+    by iterating over the link with 'async for'.
+
+    Links are created with open_socket() or open_serial(), so any number of
+    them can be driven from a single event loop without a thread per link.
+    """
+
+    # Default logging color
+    LOGGING_COLOR = TimedLogger.CYAN
+
+    # How long a partial line may sit idle before it is passed on
+    IDLE_TIMEOUT = 0.1
+
+    # How long to wait for the ready signal after connection
+    MAX_READY_WAIT = 10
+
+    def __init__(self, bufflen=1000, verbose=False):
+        self.verbose = verbose
+
+        self.last_received = 0
+        self.total_received = 0
+
+        # Received items, the oldest are dropped when the limit is reached
+        self.items = deque(maxlen=bufflen)
+        self.overflows = 0
+        self.data_ready = asyncio.Event()
+
+        self.parser = FrameParser()
+        self.flush_handle = None
+
+        # Throughput and loss counters for this link
+        self.metrics = LinkMetrics()
+
+        self.transport = None
+        self.closed = asyncio.Event()
+
+        # Only one command may be waiting on its acknowledgement at a time
+        self.command_lock = asyncio.Lock()
+
+        self.start_time = time.time()
+        self.logger = TimedLogger(self.start_time, textcolor=self.LOGGING_COLOR,
+                                  component="AsyncLink")
+
+    #
+    # asyncio.Protocol
+    #
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.total_received += len(data)
+        self.metrics.received(len(data))
+        self.add_frames(self.parser.feed(data))
+
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.parser.pending():
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.IDLE_TIMEOUT, self.flush)
+
+    def connection_lost(self, exc):
+        self.flush()
+        self.closed.set()
+
+        # Wake any waiters so that they see the link is closed
+        self.data_ready.set()
+
+    def flush(self):
+        """Pass on any pending text as a complete line"""
+        self.flush_handle = None
+        self.add_frames(self.parser.flush())
+
+    def add_frames(self, frames):
+        for (data, is_hmtl) in frames:
+            self.last_received = time.time()
+            item = InputItem(data, self.last_received, is_hmtl)
+            if len(self.items) == self.items.maxlen:
+                self.overflows += 1
+            self.items.append(item)
+            self.metrics.frame(item.is_hmtl, len(self.items))
+
+            if self.verbose:
+                item.print(self.logger)
+
+        if self.items:
+            self.data_ready.set()
+
+    def get_metrics(self):
+        """Return the link's counters and the rates since the last call"""
+        metrics = self.metrics.sample(parser=self.parser)
+        metrics["depth"] = len(self.items)
+        metrics["overflows"] = self.overflows
+        return metrics
+
+    #
+    # Reading
+    #
+    async def get(self, timeout=None):
+        """
+        Return the next item received, or None if none arrived within the
+        timeout or the link was closed.
+        """
+        while not self.items:
+            if self.closed.is_set():
+                return None
+            self.data_ready.clear()
+            try:
+                await asyncio.wait_for(self.data_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.items.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    async def get_until(self, deadline, match):
+        """
+        Return the first item for which match(item) is true, discarding others,
+        or None if the loop time deadline passes.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            item = await self.get(remaining)
+            if item is None:
+                if self.closed.is_set():
+                    return None
+                continue
+            if match(item):
+                return item
+
+    #
+    # Writing
+    #
+    def write(self, data):
+        self.transport.write(data)
+
+    async def wait_for_ready(self):
+        """Wait for the Arduino to send its ready signal"""
+        self.logger.log("***** Waiting for ready from Arduino *****")
+        loop = asyncio.get_running_loop()
+        item = await self.get_until(
+            loop.time() + self.MAX_READY_WAIT,
+            lambda item: item.data == HMTLprotocol.HMTL_CONFIG_READY)
+        if item is None:
+            raise Exception("Timed out waiting for ready signal")
+        self.logger.log("***** Recieved ready *****")
+        return True
+
+    async def send_and_confirm(self, data, terminated, timeout=10):
+        """Send a command and wait for the ACK"""
+        async with self.command_lock:
+            self.write(data)
+            if terminated:
+                self.write(HMTLprotocol.HMTL_TERMINATOR)
+
+            loop = asyncio.get_running_loop()
+            item = await self.get_until(
+                loop.time() + timeout,
+                lambda item: item.data in (HMTLprotocol.HMTL_CONFIG_ACK,
+                                           HMTLprotocol.HMTL_CONFIG_FAIL))
+            if item is None:
+                raise Exception("Timed out waiting for ACK signal")
+            if item.data == HMTLprotocol.HMTL_CONFIG_FAIL:
+                raise HMTLConfigException("Configuration command failed")
+            return True
+
+    async def get_data_msg(self, timeout=0.25):
+        """Listen on the link for a properly formatted data message"""
+        loop = asyncio.get_running_loop()
+        return await self.get_until(loop.time() + timeout,
+                                    lambda item: item.is_hmtl)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+class SerialTransport(asyncio.Transport):
+    """
+    Transport for an already opened pyserial connection, read using the event
+    loop's add_reader() on the serial port's file descriptor.  Writes are
+    made directly to the non-blocking descriptor, with anything the port
+    can not yet accept buffered and written from add_writer() so that a slow
+    link never blocks the event loop.
+    """
+
+    def __init__(self, loop, connection, protocol):
+        asyncio.Transport.__init__(self)
+        self.loop = loop
+        self.connection = connection
+        self.protocol = protocol
+        self.closing = False
+
+        self.fd = self.connection.fileno()
+        os.set_blocking(self.fd, False)
+
+        # Data waiting for the port to accept it
+        self.buffer = bytearray()
+
+        self.loop.add_reader(self.fd, self.read_ready)
+        self.loop.call_soon(self.protocol.connection_made, self)
+
+    def read_ready(self):
+        try:
+            data = self.connection.read(max(1, self.connection.in_waiting))
+        except serial.SerialException as e:
+            self.close(e)
+            return
+        if data:
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        if self.closing:
+            return
+        if not self.buffer:
+            # Write as much as the port accepts now and buffer the rest
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                self.close(e)
+                return
+            if written == len(data):
+                return
+            data = data[written:]
+            self.loop.add_writer(self.fd, self.write_ready)
+        self.buffer.extend(data)
+
+    def write_ready(self):
+        try:
+            written = os.write(self.fd, self.buffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        del self.buffer[:written]
+        if not self.buffer:
+            self.loop.remove_writer(self.fd)
+            if self.closing:
+                self.finish_close()
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self, exc=None):
+        """
+        Stop reading, closing the port once any buffered data is written or
+        at once if closed due to the error exc
+        """
+        if self.closing and exc is None:
+            return
+        if not self.closing:
+            self.closing = True
+            self.loop.remove_reader(self.fd)
+        if exc is not None and self.buffer:
+            self.buffer.clear()
+            self.loop.remove_writer(self.fd)
+        if not self.buffer:
+            self.finish_close(exc)
+
+    def finish_close(self, exc=None):
+        if self.connection.is_open:
+            self.connection.close()
+            self.loop.call_soon(self.protocol.connection_lost, exc)
+
+
+async def open_socket(address, port, bufflen=1000, verbose=False):
+    """Connect to a TCP device and return its AsyncLink"""
+    loop = asyncio.get_running_loop()
+    (transport, link) = await loop.create_connection(
+        lambda: AsyncLink(bufflen, verbose), address, port)
+    link.logger.log("AsyncLink: connected to %s:%d" % (address, port))
+    return link
+
+
+async def open_serial(device, baud=9600, bufflen=1000, verbose=False):
+    """Open a serial device and return its AsyncLink"""
+    loop = asyncio.get_running_loop()
+    connection = serial.Serial(device, baud, timeout=0)
+    link = AsyncLink(bufflen, verbose)
+    SerialTransport(loop, connection, link)
+    await asyncio.sleep(0)
+    link.logger.log("AsyncLink: connected to %s at %s baud" % (device, baud))
+    return link
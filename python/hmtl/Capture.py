@@ -0,0 +1,205 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Binary capture of link traffic and time-accurate replay of captures
+#
+################################################################################
+
+import io
+import mmap
+import struct
+import threading
+import time
+
+from hmtl.InputBuffer import InputBuffer
+from hmtl.TimedLogger import TimedLogger
+
+#
+# A capture file starts with CAPTURE_MAGIC followed by a sequence of records,
+# each a RECORD header followed by length bytes of raw data:
+#
+#   |  length (2B)  | direction | link id  |        timestamp (8B)         |
+#
+CAPTURE_MAGIC = b"HMTLCAP1"
+RECORD = struct.Struct("<HBBd")
+
+# Record directions
+DIRECTION_IN = 0   # Received from the link
+DIRECTION_OUT = 1  # Written to the link
+
+# Largest amount of data in a single record
+MAX_RECORD_DATA = 0xFFFF
+
+
+class CaptureWriter:
+    """
+    This class writes the raw traffic of one or more links to a capture file.
+    Records may be written from several threads, such as a buffer's reader
+    thread and whatever thread writes to the link.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def record(self, direction, link_id, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            for offset in range(0, len(data), MAX_RECORD_DATA):
+                chunk = data[offset:offset + MAX_RECORD_DATA]
+                self.file.write(RECORD.pack(len(chunk), direction, link_id,
+                                            timestamp))
+                self.file.write(chunk)
+                self.records += 1
+
+    def received(self, link_id, data):
+        self.record(DIRECTION_IN, link_id, data)
+
+    def sent(self, link_id, data):
+        self.record(DIRECTION_OUT, link_id, data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_records(data, offset=len(CAPTURE_MAGIC)):
+    """
+    Generate (timestamp, direction, link_id, data) tuples for the records of a
+    capture, where data is a memoryview into the capture.
+    """
+    view = memoryview(data)
+    if bytes(view[:len(CAPTURE_MAGIC)]) != CAPTURE_MAGIC:
+        raise Exception("Not an HMTL capture file")
+
+    while offset + RECORD.size <= len(view):
+        (length, direction, link_id, timestamp) = \
+            RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        if offset + length > len(view):
+            # Truncated final record
+            break
+        yield (timestamp, direction, link_id, view[offset:offset + length])
+        offset += length
+
+
+class ReplayBuffer(InputBuffer):
+    """
+    This class feeds the received data from a capture file into an InputBuffer
+    as though it were arriving from a live link.  The capture is memory-mapped
+    rather than read into memory, so long captures can be replayed.
+
+    speed scales the time between records: 1.0 replays in real time, 10.0 at
+    ten times real time and 0 (or None) as fast as possible.  If link_id is set
+    only that link's traffic is replayed.  Data written to the buffer is
+    discarded.  A replay has no file descriptor to wait on, so it is always
+    read by its own thread rather than an InputSelector.
+    """
+
+    # Default logging color
+    LOGGING_COLOR = TimedLogger.MAGENTA
+
+    # How long reads block once the capture has been fully replayed
+    IDLE_TIMEOUT = 0.1
+
+    def __init__(self, filename, speed=1.0, link_id=None, bufflen=1000,
+                 verbose=True):
+        InputBuffer.__init__(self, bufflen, verbose)
+        self.name = filename
+
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.records = read_records(self.map)
+
+        self.speed = speed
+        self.link_id = link_id
+
+        # Mapping from capture timestamps to replay times
+        self.first_timestamp = None
+        self.replay_start = None
+
+        # Data from a record that did not fit into the last read
+        self.remainder = None
+
+        # Set once every record has been replayed
+        self.finished = threading.Event()
+
+        # Set by stop() to end the replay, the capture is only closed once
+        # the reader thread has exited
+        self.stopping = threading.Event()
+
+        self.logger.log("ReplayBuffer: replaying %s at %sx" %
+                        (filename, speed if speed else "max"))
+
+    def get_reader(self):
+        return self.map
+
+    def fileno(self):
+        raise io.UnsupportedOperation("A ReplayBuffer has no file descriptor "
+                                      "and cannot be used with a selector")
+
+    def next_data(self):
+        """Return the data of the next record to replay, once it is due"""
+        for (timestamp, direction, link_id, data) in self.records:
+            if direction != DIRECTION_IN:
+                continue
+            if self.link_id is not None and link_id != self.link_id:
+                continue
+
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+                self.replay_start = time.time()
+            if self.speed:
+                due = self.replay_start + \
+                      (timestamp - self.first_timestamp) / self.speed
+                delay = due - time.time()
+                if delay > 0 and self.stopping.wait(delay):
+                    return None
+            return data
+        return None
+
+    def read_into(self, view):
+        data = self.remainder
+        if data is None:
+            data = self.next_data()
+        if data is None:
+            if not self.stopping.is_set():
+                self.finished.set()
+            self.stopping.wait(self.IDLE_TIMEOUT)
+            return 0
+
+        count = min(len(data), len(view))
+        view[:count] = data[:count]
+        self.remainder = data[count:] if count < len(data) else None
+        return count
+
+    def read(self, max_read):
+        data = bytearray(max_read)
+        return bytes(data[:self.read_into(memoryview(data))])
+
+    def write(self, data):
+        return len(data)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.receive()
+
+    def stop(self):
+        super(ReplayBuffer, self).stop()
+        self.stopping.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+        self.records.close()
+        self.remainder = None
+        self.map.close()
+        self.file.close()
@@ -7,54 +7,106 @@
 #
 ################################################################################
 
-import queue as Queue
+from collections import deque
+import threading
+import time
 
 
 class CircularBuffer:
     """
     This class presents a circular buffer that can be used to
-    consume and watch data from a stream
+    consume and watch data from a stream.  When the buffer is full the oldest
+    element is dropped to make room for the new one, and the number of
+    dropped elements is recorded in overflows.
     """
 
     def __init__(self, limit):
         self.limit = limit
-        self.queue = Queue.Queue(limit)
+        self.items = deque(maxlen=limit)
+        self.cv = threading.Condition()
+
+        # Number of elements dropped due to the buffer being full
+        self.overflows = 0
 
     def put(self, elem):
-        while True:
-            try:
-                self.queue.put(elem, False)
-                return
-            except Queue.Full as e:
-                self.queue.get(False)
+        with self.cv:
+            if len(self.items) == self.limit:
+                self.overflows += 1
+            self.items.append(elem)
+            self.cv.notify()
+
+    def put_many(self, elems):
+        with self.cv:
+            for elem in elems:
+                if len(self.items) == self.limit:
+                    self.overflows += 1
+                self.items.append(elem)
+            self.cv.notify_all()
+
+    def wait_for_data(self, block, wait):
+        """
+        Wait until the buffer is non-empty, returning False if the wait timed
+        out.  Must be called with the lock held.  A wait of None blocks forever.
+        """
+        if not block:
+            return len(self.items) > 0
+
+        deadline = None if wait is None else time.monotonic() + wait
+        while not self.items:
+            if deadline is None:
+                self.cv.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cv.wait(remaining)
+        return True
 
     def get(self, block=True, wait=3600):
-        try:
-            return self.queue.get(block, wait)
-        except Queue.Empty:
+        with self.cv:
+            if not self.wait_for_data(block, wait):
+                return None
+            return self.items.popleft()
+
+    def get_many(self, max_items=None, timeout=None):
+        """
+        Wait up to timeout for at least one element and return a list of up to
+        max_items elements, which is empty if the wait timed out.
+        """
+        with self.cv:
+            if not self.wait_for_data(True, timeout):
+                return []
+            if max_items is None or max_items >= len(self.items):
+                elems = list(self.items)
+                self.items.clear()
+            else:
+                elems = [self.items.popleft() for _ in range(max_items)]
+            return elems
+
+    def peek(self):
+        """Return the oldest element without removing it"""
+        with self.cv:
+            if self.items:
+                return self.items[0]
             return None
 
+    def snapshot(self):
+        """Return a list of the current elements without removing them"""
+        with self.cv:
+            return list(self.items)
+
     def clear(self):
-        try:
-            while True:
-                self.queue.get(False)
-        except Queue.Empty:
-            pass
+        with self.cv:
+            self.items.clear()
 
     #
-    # Iteration
+    # Iteration, which is over a snapshot and does not consume the elements
     #
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        try:
-            return self.queue.get(False)
-        except Queue.Empty:
-            raise StopIteration
+        return iter(self.snapshot())
 
     #
     # len()
     #
     def __len__(self):
-        return self.queue.qsize()
\ No newline at end of file
+        return len(self.items)
@@ -0,0 +1,188 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Incremental framing of a raw byte stream into text lines and HMTL messages
+#
+################################################################################
+
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+class FrameParser:
+    """
+    This class splits a stream of data from a reader into Arduino text lines
+    ('\n' terminated) and HMTL messages (starting with MsgHdr.STARTCODE and
+    sized by the header's length field).
+
+    Data is received into a fixed size preallocated buffer, either by having
+    the reader fill the memoryview returned by receive_buffer() directly or by
+    passing chunks to feed().  Each complete frame is copied out of the buffer
+    exactly once, and any trailing partial frame is kept for the next read.
+
+    Frames are returned as (data, is_hmtl) tuples, the header of HMTL messages
+    is left for the consumer to decode if and when it is needed.
+
+    Since a stray start code can appear in debug output or line noise, each
+    message header is validated as its bytes arrive: the protocol version, the
+    length against HMTL_MAX_MSG_LEN and the minimum for the message type, and
+    optionally the CRC.  On a bad header only the start code is discarded and
+    parsing resynchronizes on the data following it, with the number of such
+    events recorded in resyncs.  Messages failing the CRC are dropped whole.
+    """
+
+    # Size of the preallocated receive buffer
+    RECEIVE_SIZE = 4096
+
+    def __init__(self, size=RECEIVE_SIZE, check_crc=False):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+        # Modules only fill in the CRC when built with HMTL_USE_CRC
+        self.check_crc = check_crc
+
+        # Number of invalid headers skipped and messages failing their CRC
+        self.resyncs = 0
+        self.crc_errors = 0
+
+        # Unconsumed data lies between start and end
+        self.start = 0
+        self.end = 0
+
+    def receive_buffer(self):
+        """Return a writable view of the free space at the end of the buffer"""
+        if self.start > 0:
+            # Move the partial frame to the front to maximize the free space
+            pending = self.end - self.start
+            self.buffer[0:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    def commit(self, count):
+        """
+        Record that count bytes were written into the view returned by
+        receive_buffer() and return the list of complete frames.
+        """
+        self.end += count
+        return self.frames()
+
+    def feed(self, chunk):
+        """Copy a chunk of received data in and return the complete frames"""
+        frames = []
+        chunk = memoryview(chunk)
+        while len(chunk):
+            free = self.receive_buffer()
+            count = min(len(free), len(chunk))
+            free[:count] = chunk[:count]
+            frames += self.commit(count)
+            chunk = chunk[count:]
+        return frames
+
+    def flush(self):
+        """
+        Called when the reader has gone idle.  Any pending text is returned as
+        a line since Arduino output is not always newline terminated, partial
+        HMTL messages are retained until the rest of the message arrives.
+        """
+        if self.pending() and \
+                self.buffer[self.start] != HMTLprotocol.MsgHdr.STARTCODE:
+            line = self.text(self.start, self.end)
+            self.start = self.end = 0
+            if line:
+                return [(line, False)]
+        return []
+
+    def pending(self):
+        """Return the number of bytes waiting on the rest of a frame"""
+        return self.end - self.start
+
+    def text(self, start, end):
+        # Arduino print output lines are terminated with \r\n
+        return self.view[start:end].tobytes().replace(b'\r', b'')
+
+    def check_header(self, pos, available):
+        """
+        Validate as much of the message header starting at pos as has been
+        received.  Returns None if the header is invalid, otherwise the message
+        length (0 if that is not yet known).
+        """
+        data = self.buffer
+        MsgHdr = HMTLprotocol.MsgHdr
+        if available <= MsgHdr.VERSION_OFFSET:
+            return 0
+        if data[pos + MsgHdr.VERSION_OFFSET] != MsgHdr.PROTOCOL_VERSION:
+            return None
+
+        if available <= MsgHdr.LENGTH_OFFSET:
+            return 0
+        length = data[pos + MsgHdr.LENGTH_OFFSET]
+        if not (HMTLprotocol.MSG_BASE_LEN <= length <=
+                HMTLprotocol.HMTL_MAX_MSG_LEN):
+            return None
+
+        if available <= MsgHdr.TYPE_OFFSET:
+            return length
+        mtype = data[pos + MsgHdr.TYPE_OFFSET]
+        if length < HMTLprotocol.MSG_MIN_LENS.get(mtype,
+                                                  HMTLprotocol.MSG_BASE_LEN):
+            return None
+
+        return length
+
+    def frames(self):
+        data = self.buffer
+        frames = []
+        pos = self.start
+        end = self.end
+
+        while pos < end:
+            if data[pos] == HMTLprotocol.MsgHdr.STARTCODE:
+                # This is the start of an HMTL data message
+                length = self.check_header(pos, end - pos)
+                if length is None:
+                    # Not a valid message, treat what follows as new data
+                    self.resyncs += 1
+                    pos += 1
+                    continue
+                if end - pos < max(length, HMTLprotocol.MsgHdr.LENGTH):
+                    break
+
+                frame = self.view[pos:pos + length]
+                if self.check_crc and (frame[HMTLprotocol.MsgHdr.CRC_OFFSET] !=
+                                       HMTLprotocol.msg_crc(frame)):
+                    # The header was plausible so drop the corrupted message
+                    self.crc_errors += 1
+                    pos += length
+                    continue
+
+                frames.append((frame.tobytes(), True))
+                pos += length
+                continue
+
+            # Text runs until the end of the line or the start of a message
+            newline = data.find(b'\n', pos, end)
+            start = data.find(HMTLprotocol.MsgHdr.STARTCODE, pos, end)
+            if start >= 0 and (newline < 0 or start < newline):
+                stop = start
+                next_pos = start
+            elif newline >= 0:
+                stop = newline
+                next_pos = newline + 1
+            elif pos == 0 and end == len(data):
+                # The buffer is full of unterminated text, pass it on as is
+                stop = next_pos = end
+            else:
+                break
+
+            line = self.text(pos, stop)
+            if line:
+                frames.append((line, False))
+            pos = next_pos
+
+        if pos == end:
+            pos = end = 0
+        self.start = pos
+        self.end = end
+        return frames
@@ -8,10 +8,15 @@
 ################################################################################
 
 from binascii import hexlify
+from collections import deque
+import concurrent.futures
+import threading
 import time
 
 import hmtl.HMTLprotocol as HMTLprotocol
+from hmtl.InputBuffer import InputItem
 from hmtl.TimedLogger import TimedLogger
+from hmtl.WritePacer import WritePacer
 
 
 class HMTLConfigException(Exception):
@@ -26,23 +31,88 @@ class HMTLSerial():
     # How long to wait for the ready signal after connection
     MAX_READY_WAIT = 10
 
-    def __init__(self, buff, verbose=False):
-        '''Open a serial connection and wait for the ready signal'''
+    # Data received this soon after connecting may be from before the module
+    # reset, so it is ignored while waiting for the ready signal
+    READY_SETTLE_TIME = 0.5
+
+    # How long to wait for a poll response when reattaching to a module
+    PROBE_TIMEOUT = 0.5
+
+    # Bytes a module can receive before it must process them, used for batched
+    # sends when the module has not reported its buffer size
+    DEFAULT_BUFFER_SIZE = 64
+
+    def __init__(self, buff, verbose=False, window=1, reattach=False):
+        '''
+        Open a serial connection and wait for the ready signal.  If reattach
+        is set the module is assumed to already be running, and if it answers
+        a poll the wait for the ready signal is skipped.
+        '''
         self.verbose = verbose
         self.last_received = 0
         self.serial = buff
 
+        # (future, windowed, sent) for commands which have been sent and are
+        # waiting on their ACK, in the order they were written.  The module
+        # acknowledges commands in order, so each ACK or FAIL resolves the
+        # oldest pending command.  Commands sent with send_batch() do not
+        # hold a place in the window.
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+
+        # Held while waiting to write so that paced writes keep their order
+        # without blocking ACK handling
+        self.write_lock = threading.Lock()
+
+        # WritePacer limiting writes to what the link and module can absorb
+        self.pacer = None
+
+        # Limits the number of commands outstanding at once
+        self.window = threading.Semaphore(window)
+
+        self.failures = 0
+        self.unexpected_acks = 0
+
+        # PollHdr from the connected module, if it has been polled
+        self.module_info = None
+
         # Create the logger
-        self.logger = TimedLogger(self.serial.start_time, textcolor=self.LOGGING_COLOR)
+        self.logger = TimedLogger(self.serial.start_time, textcolor=self.LOGGING_COLOR,
+                                  component="HMTLSerial")
+
+        # Command acknowledgements are matched to commands as they arrive
+        self.acks = self.serial.subscribe(InputItem.ACK,
+                                          callback=self.handle_ack)
+
+        # Items are only read through subscriptions, the ready signal through
+        # one that exists while waiting for it and get_message() through one
+        # created on its first call
+        self.serial.buffered = False
+        self.text = self.serial.subscribe(InputItem.TEXT)
+        self.messages = None
 
         self.serial.start()
+        if reattach:
+            if self.probe():
+                self.logger.log("***** Reattached to module %d *****" %
+                                self.module_info.address)
+                self.text.cancel()
+                self.text = None
+                return
+            self.logger.log("No response to probe, waiting for module reset")
         if not self.wait_for_ready():
             exit(1)
 
     def get_message(self, timeout=None):
-        """Returns the next line of text or a complete HMTL message"""
+        """
+        Returns the next line of text or a complete HMTL message, or None if
+        nothing arrives within timeout seconds.  A timeout of None waits until
+        data arrives.  Only items received since the first call are returned.
+        """
+        if self.messages is None:
+            self.messages = self.serial.subscribe(None)
 
-        item = self.serial.get(wait=timeout)
+        item = self.messages.get(wait=timeout)
 
         if not item:
             return None
@@ -52,45 +122,292 @@ class HMTLSerial():
         return item
 
     # Wait for data from device indicating its ready for commands
-    def wait_for_ready(self):
+    def wait_for_ready(self, timeout=None):
         """Wait for the Arduino to send its ready signal"""
         self.logger.log("***** Waiting for ready from Arduino *****")
-        start_wait = time.time()
-        while True:
-            item = self.get_message(1.0)
+        if timeout is None:
+            timeout = self.MAX_READY_WAIT
+        deadline = time.monotonic() + timeout
+        settled = time.time() + self.READY_SETTLE_TIME
+
+        if self.text is None:
+            self.text = self.serial.subscribe(InputItem.TEXT)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for ready signal")
 
-            # After connecting to the serial device there is sometimes data
-            # from before the module resets, so wait a bit for that to clear.
-            if (time.time() - start_wait) < 0.5:
-                continue
+                # Sleeps until a line arrives or the deadline passes
+                item = self.text.get(wait=remaining)
+                if not item:
+                    continue
+                self.last_received = time.time()
 
-            if item and (item.data == HMTLprotocol.HMTL_CONFIG_READY):
-                self.logger.log("***** Recieved ready *****")
-                return True
-            if (time.time() - start_wait) > self.MAX_READY_WAIT:
-                raise Exception("Timed out waiting for ready signal")
+                # After connecting to the serial device there is sometimes
+                # data from before the module resets, so skip anything that
+                # arrived before it had a chance to clear.
+                if item.timestamp < settled:
+                    continue
+
+                if item.data == HMTLprotocol.HMTL_CONFIG_READY:
+                    self.logger.log("***** Recieved ready *****")
+                    return True
+        finally:
+            # Lines are no longer read once the module is ready
+            self.text.cancel()
+            self.text = None
 
     # Send terminated data and wait for (N)ACK
     def send_and_confirm(self, data, terminated, timeout=10):
         """Send a command and wait for the ACK"""
 
-        self.serial.write(data)
-        if (terminated):
-            self.serial.write(HMTLprotocol.HMTL_TERMINATOR)
+        future = self.send_async(data, terminated, timeout=timeout)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.abandon(future)
+            raise Exception("Timed out waiting for ACK signal")
 
-        start_wait = time.time()
-        while True:
-            item = self.get_message()
-            if item is not None:
-                if item.data == HMTLprotocol.HMTL_CONFIG_ACK:
-                    return True
-                if item.data == HMTLprotocol.HMTL_CONFIG_FAIL:
-                    raise HMTLConfigException("Configuration command failed")
-            if (time.time() - start_wait) > timeout:
-                raise Exception("Timed out waiting for ACK signal")
+    def send_async(self, data, terminated, callback=None, timeout=10):
+        """
+        Send a command without waiting for its ACK, returning a Future that
+        resolves to True on ACK or raises HMTLConfigException on FAIL.  If a
+        callback is given it is called with the Future once resolved.
+
+        Up to the window size of commands may be outstanding, beyond that this
+        blocks until an earlier command is acknowledged.
+        """
+        if not self.window.acquire(timeout=timeout):
+            raise Exception("Timed out waiting for send window")
+
+        future = concurrent.futures.Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        length = len(data)
+        if terminated:
+            length += len(HMTLprotocol.HMTL_TERMINATOR)
+
+        # Queue and write under the write lock so the pending order matches
+        # the order the commands reach the module, the pending lock is only
+        # held to queue so that ACKs can be handled during the write.
+        with self.write_lock:
+            self.wait_to_write(length)
+            with self.pending_lock:
+                self.pending.append((future, True, time.monotonic()))
+            try:
+                self.serial.write(data)
+                if (terminated):
+                    self.serial.write(HMTLprotocol.HMTL_TERMINATOR)
+            except Exception as e:
+                self.withdraw([future], e)
+                raise
+        return future
+
+    def send_batch(self, commands, buffer_size=None, timeout=10):
+        """
+        Send a sequence of (data, terminated) commands, writing as many at once
+        as fit within the module's receive buffer and then waiting for their
+        ACKs before writing the next group.  Returns True once every command
+        has been acknowledged, and raises HMTLConfigException identifying the
+        first command that failed.
+        """
+        if buffer_size is None:
+            if self.module_info is not None and self.module_info.buffer_size:
+                buffer_size = self.module_info.buffer_size
+            else:
+                buffer_size = self.DEFAULT_BUFFER_SIZE
 
+        encoded = []
+        for (data, terminated) in commands:
+            if terminated:
+                data = data + HMTLprotocol.HMTL_TERMINATOR
+            encoded.append(data)
+
+        index = 0
+        while index < len(encoded):
+            # Always send at least one command even if it exceeds the buffer
+            end = index + 1
+            size = len(encoded[index])
+            while end < len(encoded) and size + len(encoded[end]) <= buffer_size:
+                size += len(encoded[end])
+                end += 1
+
+            futures = self.write_many(encoded[index:end])
+
+            for (offset, future) in enumerate(futures):
+                try:
+                    future.result(timeout)
+                except concurrent.futures.TimeoutError:
+                    for remaining in futures[offset:]:
+                        self.abandon(remaining)
+                    raise Exception("Timed out waiting for ACK of command %d" %
+                                    (index + offset))
+                except HMTLConfigException:
+                    self.wait_for_pending(timeout)
+                    raise HMTLConfigException("Command %d of batch failed" %
+                                              (index + offset))
+            index = end
+
+        return True
+
+    def write_many(self, encoded):
+        """
+        Write several already terminated commands in a single write, returning
+        a Future for each.  These do not hold places in the window.
+        """
+        futures = [concurrent.futures.Future() for _ in encoded]
+        data = b"".join(encoded)
+        with self.write_lock:
+            self.wait_to_write(len(data))
+            with self.pending_lock:
+                sent = time.monotonic()
+                self.pending.extend((future, False, sent) for future in futures)
+            try:
+                self.serial.write(data)
+            except Exception as e:
+                self.withdraw(futures, e)
+                raise
+        return futures
+
+    def pace(self, baud=None, buffer_size=None):
+        """
+        Pace writes to the rate the link can carry, allowing bursts of up to
+        the module's receive buffer size.  The baud rate and buffer size
+        default to those the module reports when polled.
+        """
+        if self.module_info is None and (baud is None or buffer_size is None):
+            self.probe()
+        if baud is None:
+            if self.module_info is None:
+                raise Exception("Unable to determine baud rate of link")
+            baud = HMTLprotocol.byte_to_baud(self.module_info.baud)
+        if buffer_size is None:
+            if self.module_info is not None and self.module_info.buffer_size:
+                buffer_size = self.module_info.buffer_size
+            else:
+                buffer_size = self.DEFAULT_BUFFER_SIZE
+
+        self.pacer = WritePacer.from_link(baud, buffer_size)
+        self.serial.pacer = self.pacer
+        self.logger.log("Pacing writes to %d baud with %d byte bursts" %
+                        (baud, buffer_size))
+        return self.pacer
+
+    def wait_to_write(self, count):
+        """Wait until count bytes may be written, called with write_lock held"""
+        if self.pacer is not None:
+            self.pacer.acquire(count)
+
+    def handle_ack(self, item):
+        """Resolve the oldest pending command with an ACK or FAIL"""
+        with self.pending_lock:
+            if not self.pending:
+                self.unexpected_acks += 1
+                return
+            (future, windowed, sent) = self.pending.popleft()
+        if windowed:
+            self.window.release()
+
+        self.last_received = item.timestamp
+        if item.data == HMTLprotocol.HMTL_CONFIG_FAIL:
+            self.failures += 1
+            future.set_exception(
+                HMTLConfigException("Configuration command failed"))
+        else:
+            future.set_result(True)
+
+    def abandon(self, future):
+        """Stop waiting on a command that was never acknowledged"""
+        with self.pending_lock:
+            for entry in self.pending:
+                if entry[0] is future:
+                    break
+            else:
+                return
+            self.pending.remove(entry)
+            future.cancel()
+        if entry[1]:
+            self.window.release()
+
+    def withdraw(self, futures, exception):
+        """
+        Remove commands whose write failed from the pending queue, releasing
+        their places in the window and failing their Futures
+        """
+        withdrawn = []
+        with self.pending_lock:
+            for entry in list(self.pending):
+                if entry[0] in futures:
+                    self.pending.remove(entry)
+                    withdrawn.append(entry)
+        for (future, windowed, sent) in withdrawn:
+            if windowed:
+                self.window.release()
+            future.set_exception(exception)
+
+    def wait_for_pending(self, timeout=10):
+        """Wait for all outstanding commands, returning False on timeout"""
+        with self.pending_lock:
+            futures = [entry[0] for entry in self.pending]
+        (done, not_done) = concurrent.futures.wait(futures, timeout)
+        return len(not_done) == 0
+
+    def expire(self, timeout=10):
+        """
+        Abandon commands that have waited longer than timeout for their ACK,
+        cancelling their Futures.  Returns the monotonic time at which the
+        oldest remaining command will expire, or None if none are pending.
+        """
+        now = time.monotonic()
+        expired = []
+        with self.pending_lock:
+            for (future, windowed, sent) in self.pending:
+                if sent + timeout > now:
+                    break
+                expired.append(future)
+        for future in expired:
+            self.logger.log("Timed out waiting for ACK signal")
+            self.abandon(future)
+
+        with self.pending_lock:
+            if self.pending:
+                return self.pending[0][2] + timeout
+        return None
+
+    def probe(self, address=HMTLprotocol.BROADCAST, timeout=None):
+        """
+        Poll the module to check that it is alive, returning its PollHdr or
+        None if it did not respond.  The response is also kept in module_info.
+        """
+        if timeout is None:
+            timeout = self.PROBE_TIMEOUT
+        deadline = time.monotonic() + timeout
+
+        responses = self.serial.subscribe(InputItem.HMTL,
+                                          mtype=HMTLprotocol.MSG_TYPE_POLL)
+        try:
+            future = self.send_async(HMTLprotocol.get_poll_msg(address), False,
+                                     timeout=timeout)
+            item = responses.get(wait=max(deadline - time.monotonic(), 0))
+        finally:
+            responses.cancel()
+
+        if not future.done():
+            try:
+                future.result(max(deadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                self.abandon(future)
+            except HMTLConfigException:
+                pass
+
+        if item is None:
+            return None
 
-# XXX: Here we need a method of getting data back from poll or the like
+        self.last_received = item.timestamp
+        self.module_info = HMTLprotocol.msg_to_headers(item.data)[-1]
+        return self.module_info
 
     # Send a text command
     def send_command(self, command):
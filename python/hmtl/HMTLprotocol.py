@@ -10,6 +10,7 @@
 """HMTL Protocol definitions module"""
 
 import struct
+import zlib
 from binascii import hexlify
 from hmtl.constants import *
 from hmtl.config import *
@@ -31,6 +32,8 @@ MSG_HDR_FMT = "<BBBBBBH" # All HMTL messages start with this
 MSG_TYPE_OUTPUT   = 1
 MSG_TYPE_POLL     = 2
 MSG_TYPE_SET_ADDR = 3
+MSG_TYPE_SENSOR   = 4
+MSG_TYPE_TIMESYNC = 5
 MSG_TYPE_DUMPCONFIG = 0xE0
 
 # Mapping of message types to strings
@@ -38,6 +41,8 @@ MSG_TYPES = {
     MSG_TYPE_OUTPUT: "OUTPUT",
     MSG_TYPE_POLL: "POLL",
     MSG_TYPE_SET_ADDR: "SETADDR",
+    MSG_TYPE_SENSOR: "SENSOR",
+    MSG_TYPE_TIMESYNC: "TIMESYNC",
     MSG_TYPE_DUMPCONFIG: "DUMPCONFIG",
 }
 
@@ -69,6 +74,18 @@ MSG_PROGRAM_LEN = MSG_OUTPUT_LEN + 1 + MSG_PROGRAM_VALUE_LEN
 
 MSG_POLL_LEN = MSG_BASE_LEN
 MSG_DUMPCONFIG_LEN = MSG_BASE_LEN
+MSG_SET_ADDR_LEN = MSG_BASE_LEN + 4
+
+# Largest message a module will send or accept, must match HMTLMessaging.h
+HMTL_MAX_MSG_LEN = 128
+
+# Shortest valid message of each type, other types need only a full header
+MSG_MIN_LENS = {
+    MSG_TYPE_OUTPUT: MSG_OUTPUT_LEN,
+    MSG_TYPE_POLL: MSG_POLL_LEN,
+    MSG_TYPE_SET_ADDR: MSG_SET_ADDR_LEN,
+    MSG_TYPE_DUMPCONFIG: MSG_DUMPCONFIG_LEN,
+}
 
 # Broadcast address
 BROADCAST = 65535  # = (uint16_t)-1
@@ -197,6 +214,18 @@ def get_program_timed_change_msg(address, output,
     return get_program_msg(address, output, MSG_PROGRAM_TIMED_CHANGE_TYPE, msg)
 
 
+def msg_crc(data):
+    """
+    Compute the CRC of a complete message as done by modules built with
+    HMTL_USE_CRC: the low byte of the CRC-32 of the message with the crc field
+    set to zero.
+    """
+    crc = zlib.crc32(data[0:1])
+    crc = zlib.crc32(b'\0', crc)
+    crc = zlib.crc32(data[2:], crc)
+    return crc & 0xFF
+
+
 # Decode raw data into an HMTL message
 def decode_data(readdata):
     try:
@@ -238,6 +267,9 @@ def decode_msg(data):
 
 # Abstract class for all message types
 class Msg(object):
+    # Allows subclasses to declare slots, others still get a __dict__
+    __slots__ = ()
+
     @classmethod
     def from_data(cls, data, offset=0):
         header = struct.unpack_from(cls.FORMAT, data, offset)
@@ -292,6 +324,29 @@ class TCPSocketHeader(Msg):
                            self.datalen, self.flags, self.source, self.dest)
 
 
+class SlotField(object):
+    """
+    A field stored in a slot under another name, for fields that share the
+    name of a Msg classmethod.  Accessed on an instance it is the field, and
+    on the class it is still the classmethod.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return getattr(super(self.owner, cls), self.name)
+        return getattr(obj, self.slot)
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
 # HMTL Message header
 class MsgHdr(Msg):
     TYPE = "MSGHDR"
@@ -301,6 +356,24 @@ class MsgHdr(Msg):
     STARTCODE = 0xFC
     PROTOCOL_VERSION = 2
 
+    # Precompiled as headers are decoded for every received message
+    STRUCT = struct.Struct(FORMAT)
+
+    # Offsets of the fields within a packed header
+    CRC_OFFSET = 1
+    VERSION_OFFSET = 2
+    LENGTH_OFFSET = 3
+    TYPE_OFFSET = 4
+    FLAGS_OFFSET = 5
+    ADDRESS_OFFSET = 6
+
+    # Headers are created for every received message, so avoid a __dict__.
+    # The length field is kept in msg_length so that MsgHdr.length() remains
+    # the classmethod returning the header's size.
+    __slots__ = ("startcode", "crc", "version", "msg_length", "mtype",
+                 "flags", "address")
+    length = SlotField("msg_length")
+
     def __init__(self, startcode=STARTCODE, crc=0, version=PROTOCOL_VERSION, 
                  length=0, mtype=0, flags=0, address=0):
         self.startcode = startcode
@@ -330,9 +403,14 @@ class MsgHdr(Msg):
             self.address
         )
 
+    @classmethod
+    def from_data(cls, data, offset=0):
+        return cls(*cls.STRUCT.unpack_from(data, offset))
+
     def pack(self):
-        return struct.pack(self.FORMAT, self.startcode, self.crc, self.version, 
-                           self.length, self.mtype, self.flags, self.address)
+        return self.STRUCT.pack(self.startcode, self.crc, self.version,
+                                self.length, self.mtype, self.flags,
+                                self.address)
 
     def next_hdr(self, data):
         '''Return the header following the message header'''
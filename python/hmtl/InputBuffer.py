@@ -14,6 +14,8 @@ import threading
 import time
 
 from hmtl.CircularBuffer import CircularBuffer
+from hmtl.FrameParser import FrameParser
+from hmtl.LinkMetrics import LinkMetrics, MetricsLogger
 from hmtl.TimedLogger import TimedLogger
 import hmtl.HMTLprotocol as HMTLprotocol
 
@@ -33,11 +35,35 @@ class InputBuffer(threading.Thread, metaclass=ABCMeta):
         self.last_received = 0
         self.total_received = 0
 
-        # Create the buffer for storing serial data
+        # Create the buffer for storing serial data.  Owners that only read
+        # through subscriptions clear buffered so that items which nobody
+        # will read are not queued.
         self.buff = CircularBuffer(bufflen)
+        self.buffered = True
+
+        # Splits the raw data into lines and HMTL messages
+        self.parser = FrameParser()
+
+        # Throughput and loss counters for this link
+        self.metrics = LinkMetrics()
 
         self.start_time = time.time()
-        self.logger = TimedLogger(self.start_time, textcolor=self.LOGGING_COLOR)
+        self.logger = TimedLogger(self.start_time, textcolor=self.LOGGING_COLOR,
+                                  component=self.__class__.__name__)
+
+        # InputSelector servicing this buffer in place of its own thread
+        self.selector = None
+
+        # Consumers receiving only particular kinds of items
+        self.subscriptions = ()
+        self.subscription_lock = threading.Lock()
+
+        # WritePacer limiting writes to this link, reported with its metrics
+        self.pacer = None
+
+        # CaptureWriter recording this link's raw traffic
+        self.capture = None
+        self.capture_link = 0
 
         # Set as a daemon so that this thread will exit correctly
         # when the parent receives a kill signal
@@ -55,60 +81,171 @@ class InputBuffer(threading.Thread, metaclass=ABCMeta):
     def write(self, data):
         pass
 
+    def fileno(self):
+        """Return the file descriptor of the reader for use with selectors"""
+        return self.get_reader().fileno()
+
     def get_buffer(self):
         return self.buff
 
     def get(self, wait=None):
         return self.buff.get(wait=wait)
 
+    def subscribe(self, kind, mtype=None, address=None, bufflen=100,
+                  callback=None):
+        """
+        Create a Subscription that receives a copy of every item of the
+        indicated kind (InputItem.TEXT, ACK or HMTL, or None for every item),
+        optionally restricted to HMTL messages of a type and/or address.
+        Items are queued in the subscription's own buffer, or passed to
+        callback from the reader thread if one is given.
+        """
+        subscription = Subscription(self, kind, mtype, address, bufflen,
+                                    callback)
+        with self.subscription_lock:
+            self.subscriptions = self.subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.subscription_lock:
+            self.subscriptions = tuple(s for s in self.subscriptions
+                                       if s is not subscription)
+
+    def get_metrics(self):
+        """Return the link's counters and the rates since the last call"""
+        metrics = self.metrics.sample(self.buff if self.buffered else None,
+                                      self.parser)
+        if self.pacer is not None:
+            metrics["pacing"] = self.pacer.sample()
+        return metrics
+
+    def log_metrics(self, period=10.0, logger=None):
+        """Start a thread that periodically logs this link's metrics"""
+        metrics_logger = MetricsLogger([self], period, logger)
+        metrics_logger.start()
+        return metrics_logger
+
+    def capture_to(self, capture, link_id=0):
+        """
+        Record all data read from and written to this link in a CaptureWriter,
+        tagged with link_id so that several links can share a capture.
+        """
+        self.capture_link = link_id
+        self.capture = capture
+
+    def capture_sent(self, data):
+        """Record data written to the link, called by the write() methods"""
+        if self.capture is not None:
+            self.capture.sent(self.capture_link, data)
+
+    def start(self):
+        if self.selector is not None:
+            # Reads are performed by the selector's thread
+            return
+        threading.Thread.start(self)
+
     def stop(self):
         # Signal the thread to stop by setting daemon=True and letting it die
         # with the parent, or interrupt its blocking read via the buffer.
-        pass
+        if self.selector is not None:
+            self.selector.unregister(self)
+
+    def read_into(self, view):
+        """
+        Read whatever data is available into the writable view, returning the
+        number of bytes read.  Readers that support reading directly into a
+        buffer should override this to avoid the copy.
+        """
+        data = self.read(len(view))
+        if not data:
+            return 0
+        view[:len(data)] = data
+        return len(data)
 
     def run(self):
         while True:
-            data = b""
-            is_html = False
-            hdr = None
-            while True:
-                char = self.read(1)
-
-                if (char is None) or (len(char) == 0):
-                    break
-
-                self.total_received += 1
-
-                if ord(char) == HMTLprotocol.MsgHdr.STARTCODE:
-                    # This is the start of an HMTL data message
-                    is_html = True
-                if is_html:
-                    data += char
-
-                    if len(data) == HMTLprotocol.MsgHdr.length():
-                        # Received enough data for a full message header
-                        hdr = HMTLprotocol.MsgHdr.from_data(data)
-
-                        # TODO: Perform basic header validation here
-                    if hdr:
-                        if len(data) >= hdr.length:
-                            # Reached end of message
-                            break
-                else:
-                    # Arduino print output lines are terminated with \r\n
-                    if char == b'\r':
-                        continue
-                    if char == b'\n':
-                        break
-                    data += char
-
-            if data and len(data):
-                self.last_received = time.time()
-                item = InputItem(data, self.last_received, is_html)
+            self.receive()
+
+    def receive(self):
+        """
+        Read from the reader directly into the parser's receive buffer,
+        returning the number of bytes read.
+        """
+        view = self.parser.receive_buffer()
+        count = self.read_into(view)
+        if count:
+            if self.capture is not None:
+                self.capture.received(self.capture_link, view[:count])
+            self.total_received += count
+            self.metrics.received(count)
+            self.add_frames(self.parser.commit(count))
+        else:
+            # The read timed out, so anything pending is a complete line
+            self.flush()
+        return count
+
+    def flush(self):
+        """Pass on any pending text as a complete line"""
+        self.add_frames(self.parser.flush())
+
+    def add_frames(self, frames):
+        for (data, is_hmtl) in frames:
+            self.last_received = time.time()
+            item = InputItem(data, self.last_received, is_hmtl)
+            if self.buffered:
+                self.metrics.frame(item.is_hmtl,
+                                   min(len(self.buff) + 1, self.buff.limit))
                 self.buff.put(item)
+            else:
+                self.metrics.frame(item.is_hmtl, 0)
+
+            for subscription in self.subscriptions:
+                if subscription.matches(item):
+                    subscription.deliver(item)
+
+            if self.verbose:
+                item.print(self.logger)
+
+
+class Subscription:
+    """
+    A consumer's view of the items of a single kind received by an InputBuffer.
+    Waiting on a subscription only wakes for matching items, and items of
+    other kinds are left for their own consumers rather than being discarded.
+    """
+
+    def __init__(self, source, kind, mtype=None, address=None, bufflen=100,
+                 callback=None):
+        self.source = source
+        self.kind = kind
+        self.mtype = mtype
+        self.address = address
+        self.callback = callback
+        self.buff = CircularBuffer(bufflen) if callback is None else None
+
+    def matches(self, item):
+        if self.kind is not None and item.kind() != self.kind:
+            return False
+        if self.mtype is not None and item.mtype != self.mtype:
+            return False
+        if self.address is not None and item.address != self.address:
+            return False
+        return True
+
+    def deliver(self, item):
+        if self.callback is not None:
+            self.callback(item)
+        else:
+            self.buff.put(item)
+
+    def get(self, wait=None):
+        return self.buff.get(wait=wait)
+
+    def clear(self):
+        self.buff.clear()
 
-                if self.verbose:
-                    item.print(self.logger)
+    def cancel(self):
+        self.source.unsubscribe(self)
 
 
 class InputItem:
@@ -116,11 +253,58 @@ class InputItem:
     Class containing data from a single serial item
     """
 
-    def __init__(self, data, timestamp, is_hmtl=False):
+    # Kinds of items
+    TEXT = "text"
+    ACK = "ack"
+    HMTL = "hmtl"
+
+    # Text lines which are command acknowledgements
+    ACK_TOKENS = (HMTLprotocol.HMTL_CONFIG_ACK, HMTLprotocol.HMTL_CONFIG_FAIL)
+
+    # Buffers can hold many items, so avoid a __dict__ per item
+    __slots__ = ("data", "timestamp", "is_hmtl", "decoded_hdr")
+
+    def __init__(self, data, timestamp, is_hmtl=False, hdr=None):
         self.data = data
         self.timestamp = timestamp
         self.is_hmtl = is_hmtl
-        self.hdr = HMTLprotocol.MsgHdr.from_data(data) if is_hmtl else None
+        self.decoded_hdr = hdr
+
+    @property
+    def hdr(self):
+        """The MsgHdr of an HMTL message, decoded on first access"""
+        if self.decoded_hdr is None and self.is_hmtl:
+            self.decoded_hdr = HMTLprotocol.MsgHdr.from_data(self.data)
+        return self.decoded_hdr
+
+    #
+    # Header fields read directly from the raw data without decoding the
+    # header, these are None for items that are not HMTL messages.
+    #
+    @property
+    def length(self):
+        if self.is_hmtl:
+            return self.data[HMTLprotocol.MsgHdr.LENGTH_OFFSET]
+        return None
+
+    @property
+    def mtype(self):
+        if self.is_hmtl:
+            return self.data[HMTLprotocol.MsgHdr.TYPE_OFFSET]
+        return None
+
+    @property
+    def flags(self):
+        if self.is_hmtl:
+            return self.data[HMTLprotocol.MsgHdr.FLAGS_OFFSET]
+        return None
+
+    @property
+    def address(self):
+        if self.is_hmtl:
+            offset = HMTLprotocol.MsgHdr.ADDRESS_OFFSET
+            return self.data[offset] | (self.data[offset + 1] << 8)
+        return None
 
     @staticmethod
     def from_data(data, timestamp=None):
@@ -138,6 +322,13 @@ class InputItem:
 
         return InputItem(data, timestamp, is_hmtl)
 
+    def kind(self):
+        if self.is_hmtl:
+            return self.HMTL
+        if self.data in self.ACK_TOKENS:
+            return self.ACK
+        return self.TEXT
+
     def __str__(self):
         if self.is_hmtl:
             return "(%s) '%s'" % (self.hdr.msg_type(), hexlify(self.data).decode())
@@ -151,4 +342,5 @@ class InputItem:
                 return "(raw) '%s'" % (hexlify(self.data))
 
     def print(self, logger, color=None):
-        logger.log(str(self), self.timestamp, color)
\ No newline at end of file
+        logger.logf("%s", self, timestamp=self.timestamp, color=color,
+                    data=self.data)
\ No newline at end of file
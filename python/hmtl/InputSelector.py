@@ -0,0 +1,111 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Single thread that reads from many InputBuffers using a selector
+#
+################################################################################
+
+import selectors
+import socket
+import threading
+import time
+
+
+class InputSelector(threading.Thread):
+    """
+    This class services the reads of any number of InputBuffers (serial
+    devices, sockets, stdin) from one thread, waiting on all of their file
+    descriptors with the platform's best selector (epoll on Linux).
+
+    Registered buffers are not started as threads of their own, data is read
+    and framed into each buffer's CircularBuffer by this thread so the
+    buffer's get() method is used exactly as before.  When no data is pending
+    the thread sleeps in the selector without any periodic wakeups.
+    """
+
+    # How long a partial line may sit idle before it is passed on, matching
+    # the read timeout used by buffers running their own thread
+    IDLE_TIMEOUT = 0.1
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+
+        # Map of buffers to their registered file descriptors
+        self.fds = {}
+
+        # Buffers holding partial data, mapped to when it should be flushed
+        self.flush_times = {}
+
+        # Socket pair used to wake the selector when registrations change
+        (self.wakeup_recv, self.wakeup_send) = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+
+        # Set as a daemon so that this thread will exit correctly
+        # when the parent receives a kill signal
+        self.daemon = True
+
+    def register(self, buff):
+        """Have this selector perform all reads for the indicated buffer"""
+        with self.lock:
+            fd = buff.fileno()
+            buff.selector = self
+            self.fds[buff] = fd
+            self.selector.register(fd, selectors.EVENT_READ, buff)
+        self.wakeup()
+
+    def unregister(self, buff):
+        with self.lock:
+            fd = self.fds.pop(buff, None)
+            self.flush_times.pop(buff, None)
+            if fd is not None:
+                self.selector.unregister(fd)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # A wakeup is already pending
+            pass
+
+    def get_timeout(self, now):
+        """Return how long to wait before a pending line must be flushed"""
+        if not self.flush_times:
+            return None
+        return max(0, min(self.flush_times.values()) - now)
+
+    def run(self):
+        while True:
+            events = self.selector.select(self.get_timeout(time.monotonic()))
+
+            with self.lock:
+                now = time.monotonic()
+                for (key, mask) in events:
+                    buff = key.data
+                    if buff is None:
+                        self.wakeup_recv.recv(4096)
+                        continue
+                    if buff not in self.fds:
+                        continue
+
+                    if buff.receive():
+                        if buff.parser.pending():
+                            self.flush_times[buff] = now + self.IDLE_TIMEOUT
+                        else:
+                            self.flush_times.pop(buff, None)
+                    else:
+                        # Readable with no data means the reader was closed
+                        self.flush_times.pop(buff, None)
+                        self.selector.unregister(self.fds.pop(buff))
+
+                # Pass on any lines that have been idle past the timeout
+                for buff in [buff for (buff, flush_time)
+                             in self.flush_times.items() if flush_time <= now]:
+                    buff.flush()
+                    del self.flush_times[buff]
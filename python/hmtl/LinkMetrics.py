@@ -0,0 +1,141 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Throughput and loss counters for a link to HMTL modules
+#
+################################################################################
+
+from bisect import bisect_left
+import threading
+import time
+
+from hmtl.TimedLogger import TimedLogger
+from hmtl.WritePacer import WritePacer
+
+
+class LinkMetrics:
+    """
+    This class accumulates counters for the data received over a single link:
+    bytes and frames (split between HMTL messages and text lines), the maximum
+    depth the receive buffer has reached and a histogram of the time between
+    frames.  Drops and resyncs are tracked by the buffer and parser themselves
+    and are merged in by sample().
+
+    Counters are only updated from the link's reader thread, so no locking is
+    done on the update path.
+    """
+
+    # Upper bounds in seconds of the inter-arrival histogram buckets, the final
+    # bucket holds everything longer than the last bound.
+    HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+
+        self.bytes = 0
+        self.hmtl_frames = 0
+        self.text_frames = 0
+        self.max_depth = 0
+
+        self.last_arrival = None
+        self.histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+
+        # Totals as of the previous sample, used to compute rates
+        self.last_sample = (self.start_time, 0, 0, 0)
+
+    def received(self, count):
+        self.bytes += count
+
+    def frame(self, is_hmtl, depth):
+        """Record a frame being added to a buffer holding depth items"""
+        now = time.monotonic()
+        if is_hmtl:
+            self.hmtl_frames += 1
+        else:
+            self.text_frames += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+        if self.last_arrival is not None:
+            gap = now - self.last_arrival
+            self.histogram[bisect_left(self.HISTOGRAM_BOUNDS, gap)] += 1
+        self.last_arrival = now
+
+    def sample(self, buff=None, parser=None):
+        """
+        Return a dictionary of the current counters along with the rates since
+        the previous call to sample().
+        """
+        now = time.monotonic()
+        (last_time, last_bytes, last_hmtl, last_text) = self.last_sample
+        elapsed = max(now - last_time, 1e-6)
+
+        metrics = {
+            "uptime": now - self.start_time,
+            "bytes": self.bytes,
+            "hmtl_frames": self.hmtl_frames,
+            "text_frames": self.text_frames,
+            "bytes_per_sec": (self.bytes - last_bytes) / elapsed,
+            "hmtl_per_sec": (self.hmtl_frames - last_hmtl) / elapsed,
+            "text_per_sec": (self.text_frames - last_text) / elapsed,
+            "max_depth": self.max_depth,
+            "histogram": list(zip(self.HISTOGRAM_BOUNDS + (None,),
+                                  self.histogram)),
+        }
+        if buff is not None:
+            metrics["depth"] = len(buff)
+            metrics["overflows"] = buff.overflows
+        if parser is not None:
+            metrics["resyncs"] = parser.resyncs
+            metrics["crc_errors"] = parser.crc_errors
+
+        self.last_sample = (now, self.bytes, self.hmtl_frames, self.text_frames)
+        return metrics
+
+    @staticmethod
+    def format(metrics):
+        """Format the result of sample() as a single log line"""
+        text = "%.0f B/s, %.1f hmtl/s, %.1f text/s, max depth %d" % \
+               (metrics["bytes_per_sec"], metrics["hmtl_per_sec"],
+                metrics["text_per_sec"], metrics["max_depth"])
+        if "overflows" in metrics:
+            text += ", depth %d, overflows %d" % (metrics["depth"],
+                                                  metrics["overflows"])
+        if "resyncs" in metrics:
+            text += ", resyncs %d, crc errors %d" % (metrics["resyncs"],
+                                                     metrics["crc_errors"])
+        text += ", gaps %s" % " ".join(
+            "%s:%d" % ("<%gs" % bound if bound else "more", count)
+            for (bound, count) in metrics["histogram"])
+        if "pacing" in metrics:
+            text += ", pacing %s" % WritePacer.format(metrics["pacing"])
+        return text
+
+
+class MetricsLogger(threading.Thread):
+    """
+    This class periodically logs the metrics of one or more InputBuffers
+    """
+
+    def __init__(self, buffers, period=10.0, logger=None):
+        threading.Thread.__init__(self)
+
+        self.buffers = buffers
+        self.period = period
+        if logger is None:
+            logger = TimedLogger(textcolor=TimedLogger.YELLOW,
+                                 component="LinkMetrics")
+        self.logger = logger
+
+        # Set as a daemon so that this thread will exit correctly
+        # when the parent receives a kill signal
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            for buff in self.buffers:
+                self.logger.log("%s: %s" % (buff.name,
+                                            LinkMetrics.format(buff.get_metrics())))
@@ -0,0 +1,153 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Structured file sinks for TimedLogger output
+#
+################################################################################
+
+from binascii import hexlify
+import json
+import os
+import struct
+
+
+class RotatingFile:
+    """
+    A file that is rotated once it grows past max_bytes, keeping up to backups
+    previous files as filename.1 (the newest) through filename.<backups>.
+    """
+
+    def __init__(self, filename, max_bytes=0, backups=5, header=b""):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.header = header
+
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(self.header)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = "%s.%d" % (self.filename, index)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.filename, index + 1))
+        if self.backups > 0:
+            os.replace(self.filename, "%s.1" % self.filename)
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def write(self, data):
+        if self.max_bytes and self.file.tell() + len(data) > self.max_bytes \
+                and self.file.tell() > len(self.header):
+            self.rotate()
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLinesSink:
+    """
+    Writes each log line as a JSON object holding the timestamp, component,
+    text and, if present, the raw data in hex.
+    """
+
+    def __init__(self, filename, max_bytes=0, backups=5):
+        self.file = RotatingFile(filename, max_bytes, backups)
+
+    def write(self, records):
+        lines = []
+        for (logger, timestamp, color, text, data) in records:
+            record = {"time": timestamp,
+                      "component": logger.component,
+                      "text": text}
+            if data is not None:
+                record["data"] = hexlify(data).decode()
+            lines.append(json.dumps(record) + "\n")
+
+        # Each line is checked against the size limit so that a rotation
+        # never splits a record
+        for line in lines:
+            self.file.write(line.encode())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BinaryLogSink:
+    """
+    Writes log lines as compact binary records following BINARY_LOG_MAGIC:
+
+      | timestamp (8B) | component len (1B) | text len (2B) | data len (2B) |
+
+    followed by the component, the UTF-8 text and the raw data.  Files are
+    read back with read_binary_log().
+    """
+
+    def __init__(self, filename, max_bytes=0, backups=5):
+        self.file = RotatingFile(filename, max_bytes, backups,
+                                 header=BINARY_LOG_MAGIC)
+
+    def write(self, records):
+        for (logger, timestamp, color, text, data) in records:
+            component = (logger.component or "").encode()[:0xFF]
+            text = text.encode("utf-8", "replace")[:0xFFFF]
+            data = bytes(data[:0xFFFF]) if data is not None else b""
+            self.file.write(BINARY_LOG_RECORD.pack(timestamp, len(component),
+                                                   len(text), len(data)) +
+                            component + text + data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+BINARY_LOG_MAGIC = b"HMTLLOG1"
+BINARY_LOG_RECORD = struct.Struct("<dBHH")
+
+
+def read_binary_log(filename):
+    """Generate (timestamp, component, text, data) tuples from a binary log"""
+    with open(filename, "rb") as f:
+        contents = f.read()
+    if not contents.startswith(BINARY_LOG_MAGIC):
+        raise Exception("Not an HMTL binary log")
+
+    offset = len(BINARY_LOG_MAGIC)
+    while offset + BINARY_LOG_RECORD.size <= len(contents):
+        (timestamp, component_len, text_len, data_len) = \
+            BINARY_LOG_RECORD.unpack_from(contents, offset)
+        offset += BINARY_LOG_RECORD.size
+        component = contents[offset:offset + component_len].decode()
+        offset += component_len
+        text = contents[offset:offset + text_len].decode("utf-8", "replace")
+        offset += text_len
+        data = contents[offset:offset + data_len]
+        offset += data_len
+        yield (timestamp, component or None, text, data or None)
+
+
+# Sink classes by --log-format name
+SINK_FORMATS = {
+    "json": JSONLinesSink,
+    "binary": BinaryLogSink,
+}
+
+
+def open_sink(filename, log_format="json", max_bytes=0, backups=5):
+    if log_format not in SINK_FORMATS:
+        raise Exception("Unknown log format '%s'" % log_format)
+    return SINK_FORMATS[log_format](filename, max_bytes, backups)
@@ -0,0 +1,173 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Fair queueing of requests from many clients for a single consumer
+#
+################################################################################
+
+from collections import deque
+import threading
+import time
+
+
+class RequestScheduler:
+    """
+    This class queues requests from any number of clients for a single
+    consumer.  Each client has its own FIFO queue and the consumer is served
+    from the clients round robin, so a client submitting many requests cannot
+    starve the others.  When a client's queue is full put() blocks, pushing
+    back on that client alone.
+
+    A request may be queued with a key, in which case it replaces the
+    client's queued request with the same key rather than being added behind
+    it, so only the latest value is handled.  A request without a key is a
+    barrier: requests queued before it are never replaced by those after.
+    Keys are per client, requests from different clients never replace each
+    other.  The superseded callback, if given, is called with the client and
+    each request that was replaced so that its requester can be told.
+
+    Requests may also be given a priority.  Each priority is a separate lane
+    with its own queue per client, and requests are always taken from the
+    highest priority lane that has any, so ordering is only kept between
+    requests of the same priority.
+    """
+
+    def __init__(self, limit=100, superseded=None):
+        self.limit = limit
+        self.superseded = superseded
+
+        # Queue of pending requests for each (client, priority), each held as
+        # a [request, key] entry so that it can be replaced in place
+        self.queues = {}
+
+        # Entries with keys queued since the last barrier, by (client,
+        # priority) and key
+        self.keyed = {}
+
+        # Number of requests replaced by a later request from the same client
+        # with the same key
+        self.coalesced = 0
+
+        # Clients with pending requests by priority, in the order they will
+        # be served
+        self.ready = {}
+
+        self.cv = threading.Condition()
+        self.closed = False
+
+    def put(self, client, request, timeout=None, key=None, priority=0):
+        """
+        Queue a request, returning False if the client's queue stayed full.
+        A request with a key replaces any queued request of the client's with
+        the same key and priority.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        lane = (client, priority)
+        with self.cv:
+            queue = self.queues.get(lane)
+            if queue is None:
+                queue = self.queues[lane] = deque()
+                self.keyed[lane] = {}
+
+            keyed = self.keyed[lane]
+            if key is not None and key in keyed and not self.closed:
+                entry = keyed[key]
+                replaced = entry[0]
+                entry[0] = request
+                self.coalesced += 1
+            else:
+                while len(queue) >= self.limit and not self.closed:
+                    if deadline is None:
+                        self.cv.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        self.cv.wait(remaining)
+                if self.closed or self.queues.get(lane) is not queue:
+                    return False
+
+                if not queue:
+                    self.ready.setdefault(priority, deque()).append(client)
+                entry = [request, key]
+                queue.append(entry)
+                if key is None:
+                    keyed.clear()
+                else:
+                    keyed[key] = entry
+                self.cv.notify_all()
+                return True
+
+        # Called without the lock held as the callback may take its time
+        if self.superseded is not None:
+            self.superseded(client, replaced)
+        return True
+
+    def next_priority(self):
+        """Highest priority with pending requests, called with the lock held"""
+        priorities = [priority for (priority, ready) in self.ready.items()
+                      if ready]
+        if not priorities:
+            return None
+        return max(priorities)
+
+    def get(self, timeout=None):
+        """
+        Return (client, request) for the next request to handle, or
+        (None, None) if the wait timed out or the scheduler was closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cv:
+            while True:
+                priority = self.next_priority()
+                if priority is not None:
+                    break
+                if self.closed:
+                    return (None, None)
+                if deadline is None:
+                    self.cv.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return (None, None)
+                    self.cv.wait(remaining)
+
+            ready = self.ready[priority]
+            client = ready.popleft()
+            lane = (client, priority)
+            queue = self.queues[lane]
+            entry = queue.popleft()
+            (request, key) = entry
+            keyed = self.keyed[lane]
+            if key is not None and keyed.get(key) is entry:
+                # Once handled a request can no longer be replaced
+                del keyed[key]
+            if queue:
+                # Move to the back of the line behind the other clients
+                ready.append(client)
+
+            # Wake any producer blocked on a full queue
+            self.cv.notify_all()
+            return (client, request)
+
+    def remove(self, client):
+        """Discard a client and any requests it still has queued"""
+        with self.cv:
+            for lane in [lane for lane in self.queues if lane[0] == client]:
+                del self.queues[lane]
+                del self.keyed[lane]
+            for ready in self.ready.values():
+                while client in ready:
+                    ready.remove(client)
+            self.cv.notify_all()
+
+    def __len__(self):
+        with self.cv:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
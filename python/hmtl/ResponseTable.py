@@ -0,0 +1,183 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Matching of HMTL response messages to the requests that expect them
+#
+################################################################################
+
+import itertools
+import struct
+import threading
+import time
+
+from hmtl.CircularBuffer import CircularBuffer
+from hmtl.InputBuffer import InputItem
+import hmtl.HMTLprotocol as HMTLprotocol
+
+POLL_SIZE = struct.calcsize(HMTLprotocol.PollHdr.FORMAT)
+
+
+class PendingResponse:
+    """
+    The responses expected by a single request, such as a poll or a
+    configuration dump.  Responses are queued until read with get().
+    """
+
+    def __init__(self, table, address, mtype, sequence, expires):
+        self.table = table
+        self.address = address
+        self.mtype = mtype
+        self.sequence = sequence
+        self.expires = expires
+
+        self.responses = CircularBuffer(100)
+
+        # Set once the final message (one without MSG_FLAG_MORE_DATA) arrives,
+        # or the request is cancelled or expires
+        self.complete = False
+
+    def deliver(self, item):
+        self.responses.put(item)
+
+    def get(self, timeout=None):
+        """Return the next response, or None if none arrives within timeout"""
+        return self.responses.get(wait=timeout)
+
+    def done(self):
+        """Return True if all responses have arrived and been read"""
+        finished = self.complete or time.monotonic() > self.expires
+        return finished and len(self.responses) == 0
+
+    def cancel(self):
+        self.table.remove(self)
+
+
+class ResponseTable:
+    """
+    This class dispatches the HMTL messages received on a link to the requests
+    waiting for them, keyed by the address of the module expected to respond
+    and the message type of the response.  This lets several requests be in
+    flight at once without their responses being handed to the wrong
+    requester.
+
+    A response goes to the oldest matching request for its address, then to a
+    request that was broadcast, and then to the oldest request for its type as
+    not every response identifies the module that sent it.  A request remains
+    in the table while its responses have MSG_FLAG_MORE_DATA set, broadcast
+    requests remain until they expire as any number of modules may respond.
+    Messages that match no request are kept for get_unmatched().
+    """
+
+    # Seconds a request waits for each response before it is expired
+    LIFETIME = 2.0
+
+    def __init__(self, source, lifetime=None):
+        self.lifetime = self.LIFETIME if lifetime is None else lifetime
+
+        # Lists of PendingResponse by (address, mtype), oldest first
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+
+        self.unmatched = CircularBuffer(100)
+
+        self.subscriptions = []
+        self.add_source(source)
+
+    def add_source(self, source):
+        """Dispatch the messages received by another InputBuffer"""
+        self.subscriptions.append(source.subscribe(InputItem.HMTL,
+                                                   callback=self.dispatch))
+
+    def expect(self, address, mtype, lifetime=None):
+        """Register a request expecting a response of mtype from address"""
+        if lifetime is None:
+            lifetime = self.lifetime
+        with self.lock:
+            self.expire()
+            pending = PendingResponse(self, address, mtype,
+                                      next(self.sequence),
+                                      time.monotonic() + lifetime)
+            self.pending.setdefault((address, mtype), []).append(pending)
+        return pending
+
+    def remove(self, pending):
+        with self.lock:
+            self.discard(pending)
+
+    def discard(self, pending):
+        """Remove a request from the table, must be called with the lock held"""
+        pending.complete = True
+        key = (pending.address, pending.mtype)
+        entries = self.pending.get(key)
+        if entries and pending in entries:
+            entries.remove(pending)
+            if not entries:
+                del self.pending[key]
+
+    def expire(self):
+        """Remove expired requests, must be called with the lock held"""
+        now = time.monotonic()
+        for entries in list(self.pending.values()):
+            for pending in list(entries):
+                if pending.expires <= now:
+                    self.discard(pending)
+
+    @staticmethod
+    def response_address(item):
+        """Return the address of the module that sent a response"""
+        if item.mtype == HMTLprotocol.MSG_TYPE_POLL and \
+                len(item.data) >= HMTLprotocol.MsgHdr.LENGTH + POLL_SIZE:
+            # Poll responses carry the module's address in the payload
+            return HMTLprotocol.PollHdr.from_data(
+                item.data, HMTLprotocol.MsgHdr.LENGTH).address
+        return item.address
+
+    def match(self, item):
+        """Return the request a response belongs to, or None"""
+        mtype = item.mtype
+        entries = self.pending.get((self.response_address(item), mtype))
+        if entries:
+            return entries[0]
+        entries = self.pending.get((HMTLprotocol.BROADCAST, mtype))
+        if entries:
+            return entries[0]
+
+        oldest = None
+        for ((address, pending_mtype), entries) in self.pending.items():
+            if pending_mtype == mtype and \
+                    (oldest is None or entries[0].sequence < oldest.sequence):
+                oldest = entries[0]
+        return oldest
+
+    def dispatch(self, item):
+        """Pass a received message to the request expecting it"""
+        with self.lock:
+            self.expire()
+            pending = self.match(item)
+            if pending is not None:
+                pending.deliver(item)
+                pending.expires = time.monotonic() + self.lifetime
+                if not item.flags & HMTLprotocol.MSG_FLAG_MORE_DATA and \
+                        pending.address != HMTLprotocol.BROADCAST:
+                    self.discard(pending)
+                return
+        self.unmatched.put(item)
+
+    def get_unmatched(self, timeout=None):
+        """Return the next message that no request was expecting"""
+        return self.unmatched.get(wait=timeout)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(entries) for entries in self.pending.values())
+
+    def close(self):
+        for subscription in self.subscriptions:
+            subscription.cancel()
+        with self.lock:
+            for entries in list(self.pending.values()):
+                for pending in list(entries):
+                    self.discard(pending)
@@ -0,0 +1,63 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Routing of HMTL addresses to the links their modules are reached through
+#
+################################################################################
+
+import threading
+
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+class RoutingTable:
+    """
+    This class maps HMTL addresses to the link each module is reached through.
+    Routes are either configured statically or learned from the responses
+    modules send to polls, with static routes taking precedence.  Messages to
+    the broadcast address or to an address with no route go to every link.
+    """
+
+    def __init__(self, links):
+        self.links = list(links)
+
+        self.static = {}
+        self.learned = {}
+        self.lock = threading.Lock()
+
+    def add_route(self, address, link):
+        """Statically route an address to a link"""
+        with self.lock:
+            self.static[address] = link
+
+    def learn(self, address, link):
+        """
+        Record that the module with an address responded on a link, returning
+        True if this is a new or changed route
+        """
+        with self.lock:
+            if self.learned.get(address) is link:
+                return False
+            self.learned[address] = link
+            return True
+
+    def route(self, address):
+        """Return the list of links a message to an address is sent on"""
+        if address == HMTLprotocol.BROADCAST:
+            return self.links
+        with self.lock:
+            link = self.static.get(address)
+            if link is None:
+                link = self.learned.get(address)
+        if link is None:
+            return self.links
+        return [link]
+
+    def get_routes(self):
+        """Return the link of every address with a route"""
+        with self.lock:
+            routes = dict(self.learned)
+            routes.update(self.static)
+        return routes
@@ -23,11 +23,20 @@ class SerialBuffer(InputBuffer):
     LOGGING_COLOR = TimedLogger.CYAN
 
     def __init__(self, device, baud=9600, timeout=0.1, bufflen=1000,
-                 verbose=True):
+                 verbose=True, reset=True):
         InputBuffer.__init__(self, bufflen, verbose)
+        self.name = device
 
-        # Open the serial connection
-        self.connection = serial.Serial(device, baud, timeout=timeout)
+        # Open the serial connection.  Arduinos reset when DTR is asserted, so
+        # to attach to an already running module the port is opened with DTR
+        # held low.  Some platforms still pulse DTR on open unless HUPCL has
+        # been cleared on the port (eg 'stty -hupcl').
+        self.connection = serial.Serial(None, baud, timeout=timeout)
+        self.connection.port = device
+        if not reset:
+            self.connection.dtr = False
+            self.connection.rts = False
+        self.connection.open()
         self.logger.log("SerialBuffer: connected to %s at %s baud" % (device, baud),
                         color=TimedLogger.CYAN)
 
@@ -40,7 +49,16 @@ class SerialBuffer(InputBuffer):
         except serial.SerialException:
             return None
 
+    def read_into(self, view):
+        try:
+            # Wait for at least one byte, then take everything already received
+            waiting = self.connection.in_waiting
+            return self.connection.readinto(view[:max(1, waiting)])
+        except serial.SerialException:
+            return 0
+
     def write(self, data):
+        self.capture_sent(data)
         return self.connection.write(data)
 
     def stop(self):
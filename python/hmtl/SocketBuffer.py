@@ -28,6 +28,7 @@ class SocketBuffer(InputBuffer):
         InputBuffer.__init__(self, bufflen, verbose)
 
         self.address = (address, port)
+        self.name = "%s:%d" % self.address
 
         # Open the serial connection
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -46,7 +47,11 @@ class SocketBuffer(InputBuffer):
     def read(self, max_read):
         return self.sock.recv(max_read)
 
+    def read_into(self, view):
+        return self.sock.recv_into(view)
+
     def write(self, data):
+        self.capture_sent(data)
         return self.sock.sendall(data)
 
     def stop(self):
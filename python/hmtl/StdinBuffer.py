@@ -27,6 +27,11 @@ class StdinBuffer(InputBuffer):
     def read(self, max_read):
         return sys.stdin.read(max_read)
 
+    def read_into(self, view):
+        # Read the raw bytes so that input is framed the same as other readers
+        return sys.stdin.buffer.readinto1(view)
+
     def write(self, data):
+        self.capture_sent(data)
         return sys.stdin.write(data)
 
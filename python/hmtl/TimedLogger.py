@@ -7,6 +7,11 @@
 #
 ################################################################################
 
+import atexit
+from binascii import hexlify
+from collections import deque
+import sys
+import threading
 import time
 import colorama
 from colorama import Fore, Back, Style
@@ -14,7 +19,11 @@ from colorama import Fore, Back, Style
 
 class TimedLogger:
     """
-    This class is used to log text with consistent timestamps and colors
+    This class is used to log text with consistent timestamps and colors.
+
+    Lines logged with logf() are only formatted once they are known to be
+    output, and when a LogWriter is in use they are formatted and written by
+    the writer's thread rather than by the caller.
     """
 
     RED = Fore.RED
@@ -25,7 +34,17 @@ class TimedLogger:
     CYAN = Fore.CYAN
     WHITE = Fore.WHITE
 
-    def __init__(self, start_time=None, textcolor=WHITE, timecolor=GREEN):
+    # Logging levels, lines below a logger's level are discarded
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    # LogWriter used by loggers that have not been given their own
+    default_writer = None
+
+    def __init__(self, start_time=None, textcolor=WHITE, timecolor=GREEN,
+                 level=INFO, writer=None, component=None):
         if not start_time:
             self.start_time = time.time()
         else:
@@ -37,6 +56,11 @@ class TimedLogger:
         self.timecolor = timecolor
 
         self.enabled = True
+        self.level = level
+        self.writer = writer
+
+        # Name recorded with each line by structured sinks
+        self.component = component
 
     def disable(self):
         self.enabled = False
@@ -44,15 +68,189 @@ class TimedLogger:
     def enable(self):
         self.enabled = True
 
-    def log(self, text, timestamp=None, color=None):
+    def set_level(self, level):
+        self.level = level
+
+    def is_enabled(self, level=INFO):
+        return self.enabled and level >= self.level
+
+    @classmethod
+    def use_writer(cls, writer):
+        """Send the output of all loggers without their own writer to writer"""
+        cls.default_writer = writer
+
+    def log(self, text, timestamp=None, color=None, level=INFO, data=None):
+        if self.is_enabled(level):
+            self.output(text, (), timestamp, color, data)
+
+    def logf(self, template, *args, timestamp=None, color=None, level=INFO,
+             data=None):
+        """
+        Log template % args.  Formatting is skipped entirely if the line is not
+        output, and deferred to the writer's thread when queued, so arguments
+        should not be modified after the call.  Lazy can be used to defer other
+        expensive conversions such as hexlify().
+
+        data is raw bytes associated with the line, which are kept by
+        structured sinks.
+        """
+        if self.is_enabled(level):
+            self.output(template, args, timestamp, color, data)
+
+    def output(self, template, args, timestamp, color, data=None):
         if not timestamp:
             timestamp = time.time()
         if not color:
             color = self.textcolor
 
-        if self.enabled:
+        writer = self.writer or TimedLogger.default_writer
+        if writer is not None:
+            writer.put((self, timestamp, color, template, args, data))
+        else:
             # Print the timestamp
             print(self.timecolor + "[%.3f] " % (timestamp - self.start_time), end="")
 
             # Print the message and reset the color
-            print(color + text + Fore.RESET)
\ No newline at end of file
+            print(color + format_text(template, args) + Fore.RESET)
+
+    def format(self, timestamp, color, text):
+        return "%s[%.3f] %s%s%s\n" % (self.timecolor,
+                                       timestamp - self.start_time,
+                                       color, text, Fore.RESET)
+
+
+def format_text(template, args):
+    if args:
+        return template % args
+    return template
+
+
+class Lazy:
+    """
+    Argument to TimedLogger.logf() that calls func(*args) only when the line
+    is formatted, eg Lazy(hexlify_text, data)
+    """
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def hexlify_text(data):
+    return hexlify(data).decode()
+
+
+class StreamSink:
+    """
+    Writes colored log lines to a stream, stdout by default
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, records):
+        stream = self.stream or sys.stdout
+        stream.write("".join(logger.format(timestamp, color, text)
+                             for (logger, timestamp, color, text, data)
+                             in records))
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class LogWriter(threading.Thread):
+    """
+    This class writes queued log lines from a background thread, formatting
+    them there and passing each batch of pending lines to its sinks.  By
+    default the lines are written to the stream, see LogSink for structured
+    file output.
+
+    At most limit lines are queued, when the queue is full the oldest line is
+    dropped to make room and the number of dropped lines is recorded in
+    dropped, so logging never blocks on or grows with a slow sink.
+    """
+
+    # Most lines written in a single batch
+    MAX_BATCH = 256
+
+    # Default number of lines that may be queued
+    LIMIT = 10000
+
+    def __init__(self, stream=None, sinks=None, limit=None):
+        threading.Thread.__init__(self)
+
+        if sinks is None:
+            sinks = [StreamSink(stream)]
+        self.sinks = sinks
+        self.limit = self.LIMIT if limit is None else limit
+        self.entries = deque(maxlen=self.limit)
+        self.cv = threading.Condition()
+        self.pending = 0
+
+        # Number of lines dropped due to the queue being full
+        self.dropped = 0
+
+        # Set as a daemon so that this thread will exit correctly
+        # when the parent receives a kill signal
+        self.daemon = True
+
+        # Output whatever is still queued when the program exits
+        atexit.register(self.flush)
+
+    def put(self, entry):
+        with self.cv:
+            if len(self.entries) == self.limit:
+                self.dropped += 1
+            else:
+                self.pending += 1
+            self.entries.append(entry)
+            self.cv.notify_all()
+
+    def get_batch(self):
+        with self.cv:
+            while not self.entries:
+                self.cv.wait()
+            count = min(len(self.entries), self.MAX_BATCH)
+            return [self.entries.popleft() for _ in range(count)]
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            records = []
+            for (logger, timestamp, color, template, args, data) in batch:
+                try:
+                    text = format_text(template, args)
+                except Exception as e:
+                    text = "Log formatting failed for '%s': %s" % (template, e)
+                records.append((logger, timestamp, color, text, data))
+            for sink in self.sinks:
+                sink.write(records)
+
+            with self.cv:
+                self.pending -= len(batch)
+                self.cv.notify_all()
+
+    def flush(self, timeout=5):
+        """Wait for all queued lines to be written"""
+        if not self.is_alive():
+            return self.pending == 0
+        deadline = time.monotonic() + timeout
+        with self.cv:
+            while self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cv.wait(remaining)
+        return True
+
+    def close(self):
+        """Write any queued lines and close the sinks"""
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,118 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Pacing of writes to a link so they do not exceed what a module can absorb
+#
+################################################################################
+
+import threading
+import time
+
+
+class WritePacer:
+    """
+    This class paces writes to a link with a token bucket.  Tokens are bytes,
+    refilled at the rate the link can carry them and limited to the size of
+    the module's receive buffer, so a burst may fill the module's buffer at
+    once but sustained writes are held to the link's rate.
+
+    A write larger than the bucket waits for the bucket to fill and then
+    proceeds, leaving the bucket in debt so that the following writes wait
+    for it to be paid off.
+    """
+
+    # Start, 8 data and stop bits
+    BITS_PER_BYTE = 10
+
+    def __init__(self, rate, burst):
+        """Pace writes to rate bytes per second, with bursts of burst bytes"""
+        self.rate = float(rate)
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.bytes = 0
+        self.writes = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+        # Totals as of the previous sample, used to compute rates
+        self.last_sample = (self.last_refill, 0, 0, 0.0)
+
+    @classmethod
+    def from_link(cls, baud, buffer_size):
+        """Create a pacer for a serial link and a module's receive buffer"""
+        return cls(baud / cls.BITS_PER_BYTE, buffer_size)
+
+    def reserve(self, count):
+        """
+        Take count bytes worth of tokens, returning the number of seconds the
+        caller must wait before writing them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+            needed = min(count, self.burst)
+            delay = max(needed - self.tokens, 0) / self.rate
+            self.tokens -= count
+
+            self.bytes += count
+            self.writes += 1
+            if delay > 0:
+                self.delayed += 1
+                self.total_delay += delay
+                if delay > self.max_delay:
+                    self.max_delay = delay
+        return delay
+
+    def acquire(self, count):
+        """Wait until count bytes may be written, returning the time waited"""
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def sample(self):
+        """
+        Return a dictionary of the pacing counters, with the link utilization
+        and the queueing delay of writes since the previous call to sample()
+        """
+        with self.lock:
+            now = time.monotonic()
+            (last_time, last_bytes, last_writes, last_delay) = self.last_sample
+            elapsed = max(now - last_time, 1e-6)
+            writes = self.writes - last_writes
+
+            metrics = {
+                "rate": self.rate,
+                "burst": self.burst,
+                "bytes": self.bytes,
+                "writes": self.writes,
+                "delayed": self.delayed,
+                "utilization": (self.bytes - last_bytes) /
+                               (self.rate * elapsed),
+                "mean_delay": (self.total_delay - last_delay) / writes
+                              if writes else 0.0,
+                "max_delay": self.max_delay,
+            }
+
+            self.max_delay = 0.0
+            self.last_sample = (now, self.bytes, self.writes, self.total_delay)
+            return metrics
+
+    @staticmethod
+    def format(metrics):
+        """Format the result of sample() as a single log line"""
+        return "%.0f%% of %.0f B/s, %d writes (%d delayed), " \
+               "delay mean %.1fms max %.1fms" % \
+               (metrics["utilization"] * 100, metrics["rate"],
+                metrics["writes"], metrics["delayed"],
+                metrics["mean_delay"] * 1000, metrics["max_delay"] * 1000)
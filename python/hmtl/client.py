@@ -7,13 +7,16 @@
 #
 ################################################################################
 
+from collections import deque
 from multiprocessing.connection import Client
 import random
+import time
 from binascii import hexlify
 
 import hmtl.HMTLprotocol as HMTLprotocol
 import hmtl.server as server
-from hmtl.TimedLogger import TimedLogger
+import hmtl.wire
+from hmtl.TimedLogger import TimedLogger, Lazy
 
 
 class HMTLClient():
@@ -21,8 +24,8 @@ class HMTLClient():
     verbose = False
 
     def __init__(self, address='localhost', port=6000, hmtladdress=None,
-                 verbose=False, logger=True, authenticate=True):
-        self.logger = TimedLogger()
+                 verbose=False, logger=True, authenticate=True, wire=False):
+        self.logger = TimedLogger(component="HMTLClient")
         if not logger:
             self.logger.disable()
 
@@ -35,10 +38,21 @@ class HMTLClient():
                 authkey = b'secret password'
             else:
                 authkey = None
-            self.conn = Client(address, authkey=authkey)
+            if wire:
+                # Compact binary framing rather than pickled objects
+                self.conn = hmtl.wire.connect(address)
+            else:
+                self.conn = Client(address, authkey=authkey)
         except Exception as e:
             raise Exception("Failed to connect to '%s'" % (str(address)))
         random.seed()
+
+        # Notices from the server about streamed messages which were dropped or
+        # failed, as (kind, msg) with the most recent kept
+        self.stream_notices = deque(maxlen=100)
+        self.stream_drops = 0
+        self.stream_errors = 0
+
         print("HMTLClient initialized")
 
     def close(self):
@@ -46,30 +60,106 @@ class HMTLClient():
 
     def send(self, msg):
         if (self.verbose):
-            self.logger.log(" - Sending %s" % (hexlify(msg)))
+            self.logger.logf(" - Sending %s", Lazy(hexlify, msg))
 
         self.conn.send(msg)
 
-    def get_ack(self):
-        msg = self.conn.recv()
+    def stream(self, msg):
+        """
+        Send a message without waiting for any acknowledgement.  The server
+        forwards streamed messages as fast as the link allows and reports any
+        that were dropped or failed, see check_stream().
+        """
+        self.conn.send((server.SERVER_STREAM, msg))
+
+    def send_batch(self, msgs, timeout=None):
+        """
+        Send a list of messages which the server writes to the link together,
+        returning a list with True for each message the module acknowledged
+        """
+        if (self.verbose):
+            self.logger.logf(" - Sending batch of %d", len(msgs))
+        self.conn.send((server.SERVER_BATCH, list(msgs)))
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            msg = self.receive(remaining)
+            if isinstance(msg, tuple) and msg[0] == server.SERVER_BATCH_ACK:
+                return msg[1]
+            if msg == server.SERVER_NACK:
+                raise Exception("Server rejected batch")
+
+    def check_stream(self):
+        """
+        Process any stream notices already received from the server, returning
+        the total number of streamed messages dropped or failed so far
+        """
+        while self.conn.poll(0):
+            msg = self.conn.recv()
+            if not self.handle_notice(msg):
+                raise Exception("Unexpected message from server: %s" % (msg,))
+        return self.stream_drops + self.stream_errors
+
+    def handle_notice(self, msg):
+        """Record msg if it is a stream notice, returning False otherwise"""
+        if not isinstance(msg, tuple):
+            return False
+        if msg[0] == server.SERVER_STREAM_DROP:
+            self.stream_drops += 1
+        elif msg[0] == server.SERVER_STREAM_ERROR:
+            self.stream_errors += 1
+        else:
+            return False
+        self.stream_notices.append(msg)
+        if self.verbose:
+            self.logger.logf(" - Stream %s: %s", msg[0], Lazy(hexlify, msg[1]))
+        return True
+
+    def receive(self, timeout=None):
+        """
+        Return the next message from the server, waiting up to timeout
+        seconds or indefinitely if timeout is None.  Stream notices are
+        recorded rather than returned.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None and \
+                    not self.conn.poll(max(deadline - time.monotonic(), 0)):
+                raise Exception("Timed out waiting for server response")
+            msg = self.conn.recv()
+            if not self.handle_notice(msg):
+                return msg
+
+    def get_ack(self, timeout=None):
+        msg = self.receive(timeout)
         if (self.verbose):
-            self.logger.log(" - Received: '%s' '%s'" % (msg, hexlify(msg)))
+            self.logger.logf(" - Received: '%s' '%s'", msg, Lazy(hexlify, msg))
         if (msg == server.SERVER_ACK):
             return True
+        elif (msg == server.SERVER_NACK):
+            raise Exception("Server failed to forward message")
         else:
             return False
 
-    def send_and_ack(self, msg, expect_response=False):
+    def send_and_ack(self, msg, expect_response=False, timeout=None):
+        """
+        Send a message and wait for the server's acknowledgement.  If timeout
+        is set an exception is raised if the server has not acknowledged the
+        message within that many seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
         self.send(msg)
 
         # Wait for message acknowledgement
         if self.verbose:
             self.logger.log(" - Waiting on ack")
 
-        # Wait for an ack from the server
+        # Wait for an ack from the server, skipping any other messages
         has_ack = False
         while True:
-            if self.get_ack():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if self.get_ack(remaining):
                 has_ack = True
                 break
 
@@ -86,13 +176,14 @@ class HMTLClient():
                 more_data = False
 
                 # Request response data
-                msg = self.get_response_data()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                msg = self.get_response_data(remaining)
                 messages.append(msg)
 
                 if self.verbose:
                     if msg:
-                            self.logger.log(" - Received data response: '%s':\n%s" %
-                                  (hexlify(msg), HMTLprotocol.decode_data(msg)))
+                            self.logger.logf(" - Received data response: '%s':\n%s",
+                                  Lazy(hexlify, msg), Lazy(HMTLprotocol.decode_data, msg))
                     else:
                         self.logger.log(" - Failed to receive data response")
 
@@ -119,11 +210,11 @@ class HMTLClient():
 
         return [None, None]
 
-    def get_response_data(self):
+    def get_response_data(self, timeout=None):
         '''Request and attempt to retrieve response data'''
         self.conn.send(server.SERVER_DATA_REQ)
         #TODO: This should pickle some object with parameters like timeout
-        msg = self.conn.recv()
+        msg = self.receive(timeout)
         return msg
         
 
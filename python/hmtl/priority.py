@@ -0,0 +1,169 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Priority classes for messages forwarded by the command server
+#
+################################################################################
+
+from bisect import bisect_left
+import threading
+
+import hmtl.HMTLprotocol as HMTLprotocol
+
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+PRIORITIES = {
+    "low": PRIORITY_LOW,
+    "normal": PRIORITY_NORMAL,
+    "high": PRIORITY_HIGH,
+}
+PRIORITY_NAMES = dict((value, name) for (name, value) in PRIORITIES.items())
+
+
+class PriorityRule:
+    """
+    Assigns a priority to messages matching a destination address, output
+    and/or message type, where any that are None match every message
+    """
+
+    def __init__(self, priority, address=None, output=None, mtype=None):
+        self.priority = priority
+        self.address = address
+        self.output = output
+        self.mtype = mtype
+
+    def matches(self, item):
+        if not item.is_hmtl:
+            return False
+        if self.address is not None and item.address != self.address:
+            return False
+        if self.mtype is not None and item.mtype != self.mtype:
+            return False
+        if self.output is not None:
+            if item.mtype != HMTLprotocol.MSG_TYPE_OUTPUT:
+                return False
+            offset = HMTLprotocol.MsgHdr.LENGTH + 1
+            if len(item.data) <= offset or item.data[offset] != self.output:
+                return False
+        return True
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a rule of the form priority:field=value,... where the priority
+        is high, normal or low and the fields are address, output and type,
+        for instance "high:address=64" or "low:type=POLL"
+        """
+        (name, _, fields) = text.partition(":")
+        if name not in PRIORITIES:
+            raise Exception("Unknown priority '%s'" % name)
+
+        values = {}
+        for field in fields.split(","):
+            if not field:
+                continue
+            (key, _, value) = field.partition("=")
+            if key == "type":
+                mtypes = dict((mname, mtype) for (mtype, mname)
+                              in HMTLprotocol.MSG_TYPES.items())
+                values["mtype"] = mtypes[value.upper()] \
+                    if value.upper() in mtypes else int(value, 0)
+            elif key in ("address", "output"):
+                values[key] = int(value, 0)
+            else:
+                raise Exception("Unknown priority rule field '%s'" % key)
+        return cls(PRIORITIES[name], **values)
+
+    def __str__(self):
+        fields = [("address", self.address), ("output", self.output),
+                  ("type", HMTLprotocol.MSG_TYPES.get(self.mtype, self.mtype))]
+        return "%s:%s" % (PRIORITY_NAMES.get(self.priority, self.priority),
+                          ",".join("%s=%s" % (name, value)
+                                   for (name, value) in fields
+                                   if value is not None))
+
+
+def classify(rules, item):
+    """Return the priority of the first rule matching item"""
+    for rule in rules:
+        if rule.matches(item):
+            return rule.priority
+    return PRIORITY_NORMAL
+
+
+class LatencyMetrics:
+    """
+    This class records the latency of the messages in a single priority
+    class, from when the server received a message until it was written to
+    the link and until the module acknowledged it, and counts the messages
+    that were superseded by a later one before being written.
+    """
+
+    # Upper bounds in seconds of the latency histogram buckets, the final
+    # bucket holds everything longer than the last bound.
+    HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.sent_total = 0.0
+        self.sent_max = 0.0
+        self.acked = 0
+        self.acked_total = 0.0
+        self.acked_max = 0.0
+        self.histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+        self.superseded = 0
+
+    def record_sent(self, latency):
+        with self.lock:
+            self.sent += 1
+            self.sent_total += latency
+            if latency > self.sent_max:
+                self.sent_max = latency
+
+    def record_acked(self, latency):
+        with self.lock:
+            self.acked += 1
+            self.acked_total += latency
+            if latency > self.acked_max:
+                self.acked_max = latency
+            self.histogram[bisect_left(self.HISTOGRAM_BOUNDS, latency)] += 1
+
+    def record_superseded(self):
+        with self.lock:
+            self.superseded += 1
+
+    def sample(self):
+        """Return a dictionary of the counters and mean and maximum latencies"""
+        with self.lock:
+            return {
+                "sent": self.sent,
+                "sent_mean": self.sent_total / self.sent if self.sent else 0.0,
+                "sent_max": self.sent_max,
+                "acked": self.acked,
+                "acked_mean": self.acked_total / self.acked
+                              if self.acked else 0.0,
+                "acked_max": self.acked_max,
+                "superseded": self.superseded,
+                "histogram": list(zip(self.HISTOGRAM_BOUNDS + (None,),
+                                      self.histogram)),
+            }
+
+    @staticmethod
+    def format(metrics):
+        """Format the result of sample() as a single log line"""
+        text = "%d sent, queued mean %.1fms max %.1fms, " \
+               "%d acked, mean %.1fms max %.1fms" % \
+               (metrics["sent"], metrics["sent_mean"] * 1000,
+                metrics["sent_max"] * 1000, metrics["acked"],
+                metrics["acked_mean"] * 1000, metrics["acked_max"] * 1000)
+        if metrics["superseded"]:
+            text += ", %d superseded" % metrics["superseded"]
+        text += ", latency %s" % " ".join(
+            "%s:%d" % ("<%gms" % (bound * 1000) if bound else "more", count)
+            for (bound, count) in metrics["histogram"])
+        return text
@@ -3,22 +3,105 @@
 # License: MIT
 # Copyright: 2014
 #
-# Class that maintains a connection to an HMTL device and listens for commands
+# Class that maintains connections to HMTL devices and listens for commands
 # over an IP port.
 #
 ################################################################################
 
+from collections import deque
+import concurrent.futures
+import functools
 from multiprocessing.connection import Listener
+import queue
 import threading
 
 from hmtl.HMTLSerial import *
 from hmtl.InputBuffer import InputItem
-from hmtl.TimedLogger import TimedLogger
+from hmtl.priority import classify, LatencyMetrics, PRIORITY_NAMES, \
+    PRIORITY_NORMAL
+from hmtl.RequestScheduler import RequestScheduler
+from hmtl.ResponseTable import ResponseTable
+from hmtl.RoutingTable import RoutingTable
+from hmtl.TimedLogger import TimedLogger, Lazy
+
+
+# Raised for a message from a client that could not be decoded
+class MessageError(Exception):
+    pass
+
 
 SERVER_ACK = "ack"
+SERVER_NACK = "nack"
 SERVER_EXIT = "exit"
 SERVER_DATA_REQ = "data"
 
+# Streamed messages are sent as (SERVER_STREAM, msg) and are not acknowledged,
+# instead the server sends (SERVER_STREAM_DROP, msg) if a message was dropped
+# because the client was sending faster than the link could accept, or
+# (SERVER_STREAM_ERROR, msg) if the module failed to acknowledge it.
+SERVER_STREAM = "stream"
+SERVER_STREAM_DROP = "stream-drop"
+SERVER_STREAM_ERROR = "stream-error"
+
+# A batch of messages is sent as (SERVER_BATCH, [msg, ...]) and is written to
+# the link at once, the server replies with (SERVER_BATCH_ACK, [status, ...])
+# where each status is True if the module acknowledged that message.
+SERVER_BATCH = "batch"
+SERVER_BATCH_ACK = "batch-ack"
+
+# Result of a streamed message that was replaced by a later message from the
+# same client before it was sent, when coalescing
+SUPERSEDED = "superseded"
+
+
+def gather(futures):
+    """
+    Return a Future that resolves once all of futures have, to True if all
+    succeeded, to SUPERSEDED if any were superseded, or otherwise with the
+    exception of the first that failed
+    """
+    result = concurrent.futures.Future()
+    if not futures:
+        result.set_result(True)
+        return result
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.cancelled():
+                result.set_exception(
+                    Exception("Timed out waiting for ACK signal"))
+                return
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+        if any(future.result() is SUPERSEDED for future in futures):
+            result.set_result(SUPERSEDED)
+        else:
+            result.set_result(True)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+def chain(source, target):
+    """Resolve the target Future with the outcome of the source Future"""
+    def done(future):
+        if future.cancelled():
+            target.set_exception(Exception("Timed out waiting for ACK signal"))
+        elif future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
+
 
 class HMTLServer():
     address = ('localhost', 6000)
@@ -26,141 +109,672 @@ class HMTLServer():
     # Default logging color
     LOGGING_COLOR = TimedLogger.RED
 
-    def __init__(self, serial_device, address, device_scan=False, logger=True, verbose=True):
-        self.ser = serial_device
+    # How long a forwarded message may wait for the module's ACK
+    ACK_TIMEOUT = 10
+
+    def __init__(self, serial_device, address, device_scan=False, logger=True,
+                 verbose=True, listener=None, coalesce=False, priorities=None,
+                 routes=None, scan_priority=None):
+        """
+        serial_device is either a single HMTLSerial or a list of them, one
+        for each link the server forwards messages over.
+
+        Clients connect with multiprocessing.connection unless a listener is
+        given, such as a hmtl.wire.WireListener for the binary protocol.
+
+        If coalesce is set a streamed value or RGB message replaces any
+        message for the same address and output that the client streamed
+        earlier and which is still waiting to be sent.  Coalescing is per
+        client, messages from different clients never replace each other.
+        A replaced message is counted as superseded in the latency metrics
+        and the client is sent nothing for it.
+
+        priorities is a list of hmtl.priority.PriorityRule, messages matching
+        a rule with a higher priority are forwarded ahead of any queued
+        messages of lower priority.
+
+        routes maps HMTL addresses to the index of the link they are reached
+        through.  Routes are also learned from the modules' poll responses.
+
+        The device scanner's polls are queued with the clients' messages, at
+        scan_priority if given and otherwise at the priority of the first
+        rule they match.
+        """
+        if isinstance(serial_device, (list, tuple)):
+            devices = list(serial_device)
+        else:
+            devices = [serial_device]
+        self.ser = devices[0]
         self.address = address
 
         self.logger = TimedLogger(self.ser.serial.start_time,
-                                  textcolor=self.LOGGING_COLOR)
+                                  textcolor=self.LOGGING_COLOR,
+                                  component="HMTLServer")
         if not logger:
             self.logger.disable()
 
         self.terminate = False
-
-         # TODO: Is this needed at all? If so should the SerialBuffer handle synchronization?
-        self.serial_cv = threading.Condition()
-
-        self.conn = None
-        self.listener = None
+        self.stopped = threading.Event()
+
+        self.listener = listener
+
+        # Connected clients by id, whose requests are queued on each link
+        # they are routed to and sent by that link's worker
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.next_client_id = 1
+
+        self.links = [LinkWorker(self, ser, index)
+                      for (index, ser) in enumerate(devices)]
+
+        # Messages are only sent on the link their destination is reached by
+        self.routes = RoutingTable(self.links)
+        for (address, index) in (routes or {}).items():
+            self.routes.add_route(address, self.links[index])
+        for link in self.links:
+            link.ser.serial.subscribe(InputItem.HMTL,
+                                      mtype=HMTLprotocol.MSG_TYPE_POLL,
+                                      callback=functools.partial(
+                                          self.learn_route, link))
+
+        # Data responses are passed to the requests expecting them, so several
+        # polls or configuration dumps may be outstanding at once
+        self.pending_responses = ResponseTable(self.ser.serial)
+        for link in self.links[1:]:
+            self.pending_responses.add_source(link.ser.serial)
 
         self.verbose = verbose
+        self.coalesce = coalesce
+
+        # Rules assigning priorities to messages, and the latency of the
+        # messages forwarded in each priority
+        self.priorities = list(priorities or [])
+        self.latency = {}
+        self.latency_lock = threading.Lock()
 
         if device_scan:
-            self.scanner = DeviceScanner(self, verbose)
-            self.scanner.start()
+            # Started by listen() once the links can carry its polls
+            self.scanner = DeviceScanner(self, verbose,
+                                         priority=scan_priority)
         else:
             self.scanner = None
 
+    def accept_connections(self):
+        """Accept client connections until the server is closed"""
+        while not self.terminate:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                if self.terminate:
+                    break
+                self.logger.log("Failed to accept connection: %s" % e)
+                continue
+
+            with self.clients_lock:
+                client = ClientConnection(self, conn, self.next_client_id)
+                self.clients[client.client_id] = client
+                self.next_client_id += 1
+            self.logger.log("Connection %d accepted from %s:%d" %
+                            ((client.client_id,) + self.listener.last_accepted))
+            client.start()
+
+    def remove_client(self, client):
+        self.logger.log("Lost connection %d" % client.client_id)
+        with self.clients_lock:
+            self.clients.pop(client.client_id, None)
+        for link in self.links:
+            link.scheduler.remove(client)
+        client.close()
+
+    def learn_route(self, link, item):
+        """Route a module's address to the link its poll response came on"""
+        address = ResponseTable.response_address(item)
+        if self.routes.learn(address, link):
+            self.logger.log("Address %d is on link %d" % (address, link.index))
+
+    def links_for(self, item):
+        """Return the links a message is forwarded on"""
+        if not item.is_hmtl or len(self.links) == 1:
+            return self.links
+        return self.routes.route(item.address)
+
+    @staticmethod
+    def coalesce_key(item):
+        """
+        Return (address, output) for a value or RGB message, where only the
+        latest message for each is needed, or None for any other message
+        """
+        if not item.is_hmtl or item.mtype != HMTLprotocol.MSG_TYPE_OUTPUT or \
+                len(item.data) < HMTLprotocol.MsgHdr.LENGTH + \
+                HMTLprotocol.OutputHdr.LENGTH:
+            return None
+        output = HMTLprotocol.OutputHdr.from_data(item.data,
+                                                  HMTLprotocol.MsgHdr.LENGTH)
+        if output.outputtype not in (HMTLprotocol.CONFIG_TYPES["value"],
+                                     HMTLprotocol.CONFIG_TYPES["rgb"]):
+            return None
+        return (item.address, output.output)
+
+    def priority_of(self, item):
+        return classify(self.priorities, item)
+
+    def latency_metrics(self, priority):
+        with self.latency_lock:
+            metrics = self.latency.get(priority)
+            if metrics is None:
+                metrics = self.latency[priority] = LatencyMetrics()
+            return metrics
+
+    def record_latency(self, item, acked=False):
+        """Record the time since a message was received from its client"""
+        metrics = self.latency_metrics(self.priority_of(item))
+        latency = time.time() - item.timestamp
+        if acked:
+            metrics.record_acked(latency)
+        else:
+            metrics.record_sent(latency)
 
-    def get_connection(self):
-        try:
-            self.logger.log("Waiting for connection")
+    def get_latency_metrics(self):
+        """Return the latency metrics of each priority by priority name"""
+        with self.latency_lock:
+            latency = list(self.latency.items())
+        return dict((PRIORITY_NAMES.get(priority, priority), metrics.sample())
+                    for (priority, metrics) in latency)
+
+    def submit(self, client, kind, item, request_id=None, timeout=None):
+        """
+        Queue a message from a client on each link it is routed to.  The
+        client is replied to once every link's module has responded, or for
+        a streamed message only if one failed to.  Returns False if the
+        client's queue on a link stayed full.
+        """
+        priority = self.priority_of(item)
+        key = None
+        if kind == SERVER_STREAM and self.coalesce:
+            key = self.coalesce_key(item)
+
+        futures = []
+        queued = True
+        for link in self.links_for(item):
+            future = concurrent.futures.Future()
+            futures.append(future)
+            if not link.scheduler.put(client, (kind, item, future),
+                                      timeout=timeout, key=key,
+                                      priority=priority):
+                future.set_exception(Exception("Link %d queue is full" %
+                                               link.index))
+                queued = False
+
+        result = gather(futures)
+        if kind == SERVER_STREAM:
+            if queued:
+                result.add_done_callback(functools.partial(
+                    self.complete_stream, client, item, request_id=request_id))
+        else:
+            result.add_done_callback(functools.partial(
+                self.complete_msg, client, item, request_id=request_id))
+        return queued
+
+    def submit_batch(self, client, items, request_id=None):
+        """
+        Queue a batch of messages, each link writing the messages routed to
+        it at once, and reply with the status of each once all have been
+        acknowledged
+        """
+        self.logger.log("Forwarding batch of %d messages" % len(items))
+
+        # ([items], [futures]) for each link
+        batches = {}
+        results = []
+        for item in items:
+            futures = []
+            for link in self.links_for(item):
+                future = concurrent.futures.Future()
+                futures.append(future)
+                batch = batches.setdefault(link, ([], []))
+                batch[0].append(item)
+                batch[1].append(future)
+            results.append(gather(futures))
+
+        priority = max(self.priority_of(item) for item in items) \
+            if items else PRIORITY_NORMAL
+        for (link, (link_items, futures)) in batches.items():
+            if not link.scheduler.put(client, (SERVER_BATCH, link_items,
+                                               futures), priority=priority):
+                for future in futures:
+                    future.set_exception(Exception("Link %d is closed" %
+                                                   link.index))
+
+        for (item, result) in zip(items, results):
+            result.add_done_callback(
+                lambda future, item=item: self.record_latency(item, acked=True))
+        gather(results).add_done_callback(functools.partial(
+            self.complete_batch, client, results, request_id=request_id))
+
+    def complete_msg(self, client, item, future, request_id=None):
+        """Reply to the client once the module has responded to its message"""
+        self.record_latency(item, acked=True)
+        if not future.cancelled() and future.exception() is None:
+            self.logger.logf("Acked: %s", item)
+            client.send(SERVER_ACK, request_id)
+        else:
+            self.logger.logf("Failed: %s", item)
+            client.cancel_response(item)
+            client.send(SERVER_NACK, request_id)
+
+    def complete_stream(self, client, item, future, request_id=None):
+        """Tell the client if the module failed to acknowledge its message"""
+        if future.cancelled() or future.exception() is not None:
+            self.record_latency(item, acked=True)
+            client.stream_errors += 1
+            client.send((SERVER_STREAM_ERROR, item.data), request_id)
+        elif future.result() is not SUPERSEDED:
+            self.record_latency(item, acked=True)
+
+    def supersede(self, client, request):
+        """Resolve a streamed message replaced by a later one before sending"""
+        (kind, item, future) = request
+        self.latency_metrics(self.priority_of(item)).record_superseded()
+        future.set_result(SUPERSEDED)
+
+    def complete_batch(self, client, results, future, request_id=None):
+        statuses = [result.exception() is None for result in results]
+        self.logger.log("Batch complete, %d of %d acked" %
+                        (sum(statuses), len(statuses)))
+        client.send((SERVER_BATCH_ACK, statuses), request_id)
+
+    def send_data(self, data, client=None, priority=None):
+        """
+        Queue a message on each link it is routed to for the server's own
+        use, waiting for the ACKs.  The message is queued as from client and
+        with the priority of the first rule it matches unless one is given.
+        """
+        item = InputItem.from_data(data)
+        if priority is None:
+            priority = self.priority_of(item)
+
+        futures = []
+        for link in self.links_for(item):
+            future = concurrent.futures.Future()
+            futures.append(future)
+            if not link.scheduler.put(client, (None, item, future),
+                                      priority=priority):
+                future.set_exception(Exception("Link %d is closed" %
+                                               link.index))
+        return gather(futures).result(self.ACK_TIMEOUT)
+
+    # Wait for and handle incoming connections
+    def listen(self):
+        self.logger.log("Server started")
+        if self.listener is None:
             self.listener = Listener(self.address, authkey=b'secret password')
-            self.conn = self.listener.accept()
-            self.logger.log("Connection accepted from %s:%d" %
-                            self.listener.last_accepted)
+
+        acceptor = threading.Thread(target=self.accept_connections)
+        acceptor.daemon = True
+        acceptor.start()
+
+        for link in self.links:
+            link.start()
+        if self.scanner is not None:
+            self.scanner.start()
+
+        try:
+            # Requests are handled by the link workers, wake periodically so
+            # that an interrupt is noticed
+            while not self.stopped.wait(1):
+                pass
         except KeyboardInterrupt:
             print("Exiting")
-            self.terminate = True
-
-    def handle_msg(self, item):
-        if item.data == SERVER_EXIT:
-            self.logger.log("* Received exit signal *")
-            self.conn.send(SERVER_ACK)
             self.close()
-        elif item.data == SERVER_DATA_REQ:
-            self.logger.log("* Recieved data request")
-            item = self.get_data_msg()
-            if item:
-                self.conn.send(item.data)
-            else:
-                self.conn.send(None)
+
+    def close(self):
+        self.terminate = True
+        self.stopped.set()
+        for link in self.links:
+            link.close()
+        self.pending_responses.close()
+        if self.listener:
+            self.listener.close()
+        with self.clients_lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.close()
+
+        for (name, metrics) in self.get_latency_metrics().items():
+            self.logger.log("Latency of %s priority: %s" %
+                            (name, LatencyMetrics.format(metrics)))
+
+    def get_data_msg(self, timeout=0.25, pending=None):
+        """
+        Wait for the next response to a request registered with
+        pending_responses.expect(), or if pending is None for the next
+        data message that no request was expecting
+        """
+        self.logger.log("Starting data request")
+
+        if pending is not None:
+            item = pending.get(timeout)
+        else:
+            item = self.pending_responses.get_unmatched(timeout)
+        if item:
+            self.logger.logf("Received response: %s:\n%s", item,
+                             Lazy(HMTLprotocol.decode_data, item.data))
         else:
-            # Forward the message to the device
-            self.serial_cv.acquire()
-            self.send_data(item.data)
-            self.serial_cv.release()
+            self.logger.log("Data request time limit exceeded")
 
-            # Reply with acknowledgement
-            self.conn.send(SERVER_ACK)
+        return item
 
-    def send_data(self, data):
-        self.serial_cv.acquire()
-        self.ser.send_and_confirm(data, False)
-        self.serial_cv.release()
 
-    # Wait for and handle incoming connections
-    def listen(self):
-        self.logger.log("Server started")
-        self.get_connection()
+class LinkWorker(threading.Thread):
+    """
+    This class sends the messages queued for a single link, so that each link
+    the server forwards messages over is written to concurrently.  Requests
+    are (kind, item, future) with the future resolved once the module has
+    responded, or for a batch (SERVER_BATCH, [item, ...], [future, ...]).
+    """
 
-        while not self.terminate:
+    def __init__(self, server, ser, index):
+        threading.Thread.__init__(self)
+
+        self.server = server
+        self.ser = ser
+        self.index = index
+
+        # Requests from each client routed to this link
+        self.scheduler = RequestScheduler(superseded=server.supersede)
+
+        # Set as a daemon so that this thread will exit correctly
+        # when the parent receives a kill signal
+        self.daemon = True
+
+    def run(self):
+        expires = None
+        while not self.scheduler.closed:
             try:
-                data = self.conn.recv()
-                item = InputItem.from_data(data)
+                # Wake for the next request or when the oldest message
+                # forwarded to the module should have been acknowledged
+                timeout = None
+                if expires is not None:
+                    timeout = max(expires - time.monotonic(), 0)
+                (client, request) = self.scheduler.get(timeout)
 
-                self.logger.log("Received: %s" % item)
-                self.handle_msg(item)
-                self.logger.log("Acked: %s" % item)
+                if client is not None:
+                    self.handle_request(request)
+                expires = self.ser.expire(self.server.ACK_TIMEOUT)
 
-            except (EOFError, IOError):
-                # Attempt to reconnect
-                self.logger.log("Lost connection")
-                self.listener.close()
-                self.get_connection()
             except Exception as e:
-                # Close the connection on uncaught exception
-                self.logger.log("Exception during listen")
-                self.close()
+                # Close the server on uncaught exception
+                self.server.logger.log("Exception on link %d" % self.index)
+                self.server.close()
                 raise e
 
+    def handle_request(self, request):
+        (kind, payload, future) = request
+        if kind == SERVER_BATCH:
+            try:
+                sent = self.ser.write_many([item.data for item in payload])
+            except Exception as e:
+                self.server.logger.log("Failed to forward batch on link %d: %s"
+                                       % (self.index, e))
+                for target in future:
+                    target.set_exception(e)
+                return
+            for (item, source, target) in zip(payload, sent, future):
+                self.server.record_latency(item)
+                chain(source, target)
+            return
+
+        try:
+            sent = self.ser.send_async(payload.data, False,
+                                       timeout=self.server.ACK_TIMEOUT)
+        except Exception as e:
+            self.server.logger.log("Failed to forward message on link %d: %s" %
+                                   (self.index, e))
+            future.set_exception(e)
+            return
+        self.server.record_latency(payload)
+        chain(sent, future)
+
     def close(self):
-        self.listener.close()
-        if self.conn:
-            self.conn.close()
-        self.terminate = True
+        self.scheduler.close()
 
-    def get_data_msg(self, timeout=0.25):
-        """Listen on the serial device for a properly formatted data message"""
 
-        self.serial_cv.acquire()
-        self.logger.log("Starting data request")
-        
-        time_limit = time.time() + timeout
-        item = None
-        while True:
-            # Try to get a message with low timeout
-            item = self.ser.get_message(timeout=0.1)
-            if item and item.is_hmtl:
-                self.logger.log("Received response: %s:\n%s" %
-                                (item, HMTLprotocol.decode_data(item.data)))
-                break
+class ClientConnection(threading.Thread):
+    """
+    This class reads messages from a single client connection and queues them
+    for the server to handle.  Replies may be sent from any thread, they are
+    queued and written by the connection's sender thread so that a client
+    which is slow to read never blocks the thread replying to it.
+    """
+
+    # Replies which may be waiting to be written before a client that is not
+    # reading them is disconnected
+    OUTBOUND_LIMIT = 1000
+
+    # How long close() waits for queued replies to be written
+    CLOSE_TIMEOUT = 1.0
+
+    def __init__(self, server, conn, client_id):
+        threading.Thread.__init__(self)
+
+        self.server = server
+        self.conn = conn
+        self.client_id = client_id
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+        # (data, request_id) for each reply waiting to be written, ending with
+        # None once the connection is closed
+        self.outbound = queue.Queue(self.OUTBOUND_LIMIT)
+        self.aborted = False
+        self.sender = threading.Thread(target=self.drain)
+        self.sender.daemon = True
+
+        # (item, PendingResponse) for each message sent that expects a
+        # response, oldest first
+        self.responses = deque()
+        self.responses_lock = threading.Lock()
+
+        # Streamed messages which were dropped or not acknowledged
+        self.stream_drops = 0
+        self.stream_errors = 0
 
-            # Check for timeout
-            if time.time() > time_limit:
-                self.logger.log("Data request time limit exceeded")
-                item = None
+        # Set as a daemon so that this thread will exit correctly
+        # when the parent receives a kill signal
+        self.daemon = True
+
+    def run(self):
+        try:
+            self.handle_messages()
+        finally:
+            # Never leave a client registered once its thread exits
+            self.server.remove_client(self)
+
+    def handle_messages(self):
+        """Handle the client's messages until it disconnects or exits"""
+        while not self.closed:
+            try:
+                data = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            except MessageError as e:
+                # The malformed message has been consumed, so the connection
+                # is still usable
+                self.server.logger.log("Rejected message from %d: %s" %
+                                       (self.client_id, e))
+                self.send(SERVER_NACK, getattr(self.conn, "last_request_id",
+                                               None))
+                continue
+            # Connections with request ids (the binary wire protocol) record
+            # the id of the message just received
+            request_id = getattr(self.conn, "last_request_id", None)
+
+            if data == SERVER_DATA_REQ:
+                # Waiting for a response only holds up this client
+                self.data_request(request_id)
+                continue
+
+            if data == SERVER_EXIT:
+                self.server.logger.log("* Received exit signal *")
+                self.send(SERVER_ACK, request_id)
+                self.server.close()
                 break
 
-        self.serial_cv.release()
+            if isinstance(data, tuple) and data[0] == SERVER_STREAM:
+                self.stream(data[1], request_id)
+                continue
+
+            if isinstance(data, tuple) and data[0] == SERVER_BATCH:
+                if not all(self.valid_message(msg) for msg in data[1]):
+                    self.server.logger.log("Rejected batch with a short "
+                                           "message from %d" %
+                                           self.client_id)
+                    self.send(SERVER_NACK, request_id)
+                    continue
+                items = [InputItem.from_data(msg) for msg in data[1]]
+                self.server.logger.logf("Received batch of %d from %d",
+                                        len(items), self.client_id)
+                self.server.submit_batch(self, items, request_id)
+                continue
+
+            if not self.valid_message(data):
+                self.server.logger.log("Rejected short message from %d" %
+                                       self.client_id)
+                self.send(SERVER_NACK, request_id)
+                continue
+            item = InputItem.from_data(data)
+            self.server.logger.logf("Received from %d: %s", self.client_id,
+                                    item)
+            if item.is_hmtl and item.flags & HMTLprotocol.MSG_FLAG_RESPONSE:
+                self.expect_response(item)
+            self.server.submit(self, None, item, request_id)
+
+    @staticmethod
+    def valid_message(data):
+        """Return True if data is long enough to hold a message header"""
+        return len(data) >= HMTLprotocol.MsgHdr.LENGTH
+
+    def stream(self, data, request_id=None):
+        """
+        Queue a streamed message, dropping it rather than waiting if the
+        client's queue is full.  When coalescing, a value or RGB message
+        replaces the unsent one for the same output.
+        """
+        if not self.valid_message(data):
+            self.stream_errors += 1
+            self.send((SERVER_STREAM_ERROR, data), request_id)
+            return
+        item = InputItem.from_data(data)
+        self.server.logger.logf("Streamed from %d: %s", self.client_id, item,
+                                level=TimedLogger.DEBUG)
+        if not self.server.submit(self, SERVER_STREAM, item, request_id,
+                                  timeout=0):
+            self.stream_drops += 1
+            self.send((SERVER_STREAM_DROP, data), request_id)
+
+    def expect_response(self, item):
+        """
+        Register the response expected to a message before it is forwarded,
+        so that the response can not arrive before it is expected
+        """
+        pending = self.server.pending_responses.expect(item.address,
+                                                       item.mtype)
+        with self.responses_lock:
+            self.responses.append((item, pending))
+
+    def cancel_response(self, item):
+        """Stop waiting for the response to a message that was not sent"""
+        with self.responses_lock:
+            for (expected, pending) in list(self.responses):
+                if expected is item:
+                    pending.cancel()
+                    self.responses.remove((expected, pending))
+
+    def data_request(self, request_id=None):
+        """Reply with the next response to this client's messages"""
+        self.server.logger.log("* Received data request from %d" %
+                               self.client_id)
+        with self.responses_lock:
+            while self.responses and self.responses[0][1].done():
+                self.responses.popleft()[1].cancel()
+            pending = self.responses[0][1] if self.responses else None
+
+        item = self.server.get_data_msg(pending=pending)
+        self.send(item.data if item else None, request_id)
+
+    def start(self):
+        threading.Thread.start(self)
+        self.sender.start()
+
+    def send(self, data, request_id=None):
+        """Queue a reply to the client, this never blocks on the connection"""
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                self.outbound.put_nowait((data, request_id))
+            except queue.Full:
+                self.server.logger.log("Connection %d is not reading replies" %
+                                       self.client_id)
+                self.closed = True
+                self.aborted = True
+                return False
+        return True
+
+    def drain(self):
+        """Write queued replies until the connection is closed"""
+        while True:
+            reply = self.outbound.get()
+            if reply is None or self.aborted:
+                break
+            (data, request_id) = reply
+            try:
+                if request_id is None:
+                    self.conn.send(data)
+                else:
+                    self.conn.send(data, request_id)
+            except (EOFError, IOError):
+                break
+        self.conn.close()
 
-        return item
+    def close(self):
+        with self.send_lock:
+            if not self.closed:
+                self.closed = True
+                try:
+                    self.outbound.put_nowait(None)
+                except queue.Full:
+                    self.aborted = True
+
+        # Give the sender a chance to write the replies already queued, such
+        # as the acknowledgement of an exit request
+        if self.sender.is_alive() and \
+                threading.current_thread() is not self.sender:
+            self.sender.join(self.CLOSE_TIMEOUT)
+        self.conn.close()
+        with self.responses_lock:
+            for (item, pending) in self.responses:
+                pending.cancel()
+            self.responses.clear()
 
 
 class DeviceScanner(threading.Thread):
     """
     This class performs a background scan for HMTL devices and maintains a list
-    of discovered devices
+    of discovered devices.  Its polls are queued on the links like a client's
+    messages, at priority if given.
     """
 
-    def __init__(self, server, verbose=True, period=60.0):
+    def __init__(self, server, verbose=True, period=60.0, priority=None):
         threading.Thread.__init__(self)
 
         self.server = server
         self.verbose = verbose
+        self.priority = priority
 
         self.logger = TimedLogger(self.server.ser.serial.start_time,
-                                  textcolor=TimedLogger.MAGENTA)
+                                  textcolor=TimedLogger.MAGENTA,
+                                  component="DeviceScanner")
         self.logger.log("Scanner initialized")
 
         # Period between scans
@@ -199,9 +813,11 @@ class DeviceScanner(threading.Thread):
 
                 msg = HMTLprotocol.get_poll_msg(address)
 
+                pending = self.server.pending_responses.expect(
+                    address, HMTLprotocol.MSG_TYPE_POLL)
                 try:
-                    self.server.send_data(msg)
-                    item = self.server.get_data_msg()
+                    self.server.send_data(msg, self, self.priority)
+                    item = self.server.get_data_msg(pending=pending)
                     if item:
                         (text, msg) = HMTLprotocol.decode_msg(item.data)
                         if (isinstance(msg, HMTLprotocol.PollHdr)):
@@ -222,6 +838,8 @@ class DeviceScanner(threading.Thread):
                 except Exception as e:
                     print("Exception: %s" % e)
                     pass
+                finally:
+                    pending.cancel()
 
                 time.sleep(self.address_period)
 
@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+from hmtl.AsyncLink import open_serial, open_socket
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+async def fake_module(reader, writer):
+    """Acknowledge every message and answer polls like a module would"""
+    writer.write(b"ready\r\n")
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            break
+        writer.write(b"ok\r\n")
+        if data[4] == HMTLprotocol.MSG_TYPE_POLL:
+            writer.write(b"debug output\r\n" + HMTLprotocol.get_poll_msg(7))
+        await writer.drain()
+    writer.close()
+
+
+async def run_link():
+    server = await asyncio.start_server(fake_module, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    link = await open_socket("127.0.0.1", port)
+    assert await link.wait_for_ready()
+
+    msg = HMTLprotocol.get_value_msg(7, 0, 100)
+    assert await link.send_and_confirm(msg, False, timeout=1)
+
+    await link.send_and_confirm(HMTLprotocol.get_poll_msg(7), False, timeout=1)
+    item = await link.get_data_msg(timeout=1)
+    assert item.is_hmtl
+    assert item.hdr.mtype == HMTLprotocol.MSG_TYPE_POLL
+
+    # Nothing further arrives so the request times out
+    assert await link.get_data_msg(timeout=0.05) is None
+
+    link.close()
+    items = [item async for item in link]
+    assert items == []
+
+    server.close()
+    await server.wait_closed()
+
+
+def test_socket_link():
+    asyncio.run(run_link())
+
+
+async def run_serial_link():
+    # The link's end of a pseudo-terminal stands in for the serial port
+    (module, port) = os.openpty()
+    loop = asyncio.get_running_loop()
+
+    link = await open_serial(os.ttyname(port), 115200)
+    os.write(module, b"ready\r\n")
+    assert await link.wait_for_ready()
+
+    # A write larger than the port can take does not block the event loop,
+    # the remainder is written as the module reads
+    data = bytes(range(0, 256)) * 256
+    start = loop.time()
+    link.write(data)
+    assert loop.time() - start < 0.1
+    assert link.transport.get_write_buffer_size() > 0
+
+    received = b""
+    while len(received) < len(data):
+        received += await loop.run_in_executor(None, os.read, module, 65536)
+    assert received == data
+    assert link.transport.get_write_buffer_size() == 0
+
+    msg = HMTLprotocol.get_value_msg(7, 0, 100)
+    os.write(module, b"ok\r\n")
+    assert await link.send_and_confirm(msg, False, timeout=1)
+    assert await loop.run_in_executor(None, os.read, module, 4096) == msg
+
+    link.close()
+    await asyncio.wait_for(link.closed.wait(), 1)
+    os.close(module)
+    os.close(port)
+
+
+def test_serial_link():
+    asyncio.run(run_serial_link())
@@ -0,0 +1,81 @@
+import io
+import time
+
+import pytest
+
+from hmtl.Capture import CaptureWriter, ReplayBuffer, read_records, \
+    DIRECTION_IN, DIRECTION_OUT
+from hmtl.tests.test_InputSelector import PairBuffer
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def test_capture_link(tmp_path):
+    filename = str(tmp_path / "link.cap")
+    capture = CaptureWriter(filename)
+
+    buff = PairBuffer()
+    buff.capture_to(capture, link_id=3)
+    buff.start()
+
+    msg = HMTLprotocol.get_poll_msg(1)
+    buff.write(msg)
+    buff.remote.sendall(b"ready\r\n")
+    assert buff.get(wait=1).data == b"ready"
+    capture.close()
+
+    with open(filename, "rb") as f:
+        records = [(direction, link_id, bytes(data))
+                   for (timestamp, direction, link_id, data)
+                   in read_records(f.read())]
+    assert records == [(DIRECTION_OUT, 3, msg), (DIRECTION_IN, 3, b"ready\r\n")]
+
+
+def test_replay(tmp_path):
+    filename = str(tmp_path / "replay.cap")
+    capture = CaptureWriter(filename)
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    capture.record(DIRECTION_IN, 0, b"ready\r\nok", timestamp=100.0)
+    capture.record(DIRECTION_OUT, 0, msg, timestamp=100.1)
+    capture.record(DIRECTION_IN, 0, b"\r\n" + msg, timestamp=100.2)
+    capture.record(DIRECTION_IN, 1, b"other link\r\n", timestamp=100.3)
+    capture.close()
+
+    # Real time replay preserves the gaps between records
+    buff = ReplayBuffer(filename, speed=1.0, link_id=0, verbose=False)
+    start = time.time()
+    buff.start()
+    assert buff.get(wait=1).data == b"ready"
+    assert buff.get(wait=1).data == b"ok"
+    item = buff.get(wait=1)
+    assert item.is_hmtl and item.address == 5
+    assert time.time() - start >= 0.2
+    assert buff.finished.wait(1)
+
+    # Unfiltered and as fast as possible
+    buff = ReplayBuffer(filename, speed=0, verbose=False)
+    buff.start()
+    assert buff.finished.wait(1)
+    assert [item.data for item in buff.get_buffer()] == \
+        [b"ready", b"ok", msg, b"other link"]
+
+
+def test_replay_stop(tmp_path):
+    filename = str(tmp_path / "stop.cap")
+    capture = CaptureWriter(filename)
+    capture.record(DIRECTION_IN, 0, b"ready\r\n", timestamp=100.0)
+    capture.record(DIRECTION_IN, 0, b"late\r\n", timestamp=160.0)
+    capture.close()
+
+    buff = ReplayBuffer(filename, speed=1.0, verbose=False)
+    with pytest.raises(io.UnsupportedOperation):
+        buff.fileno()
+
+    # Stopping interrupts the wait for the next record and waits for the
+    # reader before the capture is closed
+    buff.start()
+    assert buff.get(wait=1).data == b"ready"
+    start = time.monotonic()
+    buff.stop()
+    assert time.monotonic() - start < 0.5
+    assert not buff.is_alive()
+    assert not buff.finished.is_set()
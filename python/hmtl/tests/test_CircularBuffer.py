@@ -32,3 +32,25 @@ def test_iteration():
         assert x == y
         y += 1
 
+
+    # Iteration does not consume the elements
+    assert len(buff) == limit
+
+
+def test_overflow_count():
+    buff = CircularBuffer(4)
+    buff.put_many(range(0, 10))
+
+    assert buff.overflows == 6
+    assert buff.snapshot() == [6, 7, 8, 9]
+
+
+def test_get_many():
+    buff = CircularBuffer(10)
+    buff.put_many(range(0, 5))
+
+    assert buff.peek() == 0
+    assert buff.get_many(3) == [0, 1, 2]
+    assert buff.get_many() == [3, 4]
+    assert buff.get_many(timeout=0.01) == []
+    assert buff.get(wait=0.01) is None
@@ -0,0 +1,118 @@
+from hmtl.FrameParser import FrameParser
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+
+def test_text_lines():
+    parser = FrameParser()
+    frames = parser.feed(b"ready\r\nok\r\npart")
+
+    assert frames == [(b"ready", False), (b"ok", False)]
+    assert parser.pending() == 4
+    assert parser.feed(b"ial\r\n") == [(b"partial", False)]
+
+
+def test_hmtl_message():
+    msg = HMTLprotocol.get_rgb_msg(128, 1, 255, 0, 0)
+    parser = FrameParser()
+
+    assert parser.feed(msg[:5]) == []
+    assert parser.feed(msg[5:]) == [(msg, True)]
+    assert parser.pending() == 0
+
+
+def test_mixed_stream():
+    poll = HMTLprotocol.get_poll_msg(5)
+    value = HMTLprotocol.get_value_msg(5, 0, 100)
+    parser = FrameParser()
+
+    frames = parser.feed(b"ok\r\n" + poll + b"debug" + value + b"\r\nok\n")
+
+    assert frames == [(b"ok", False), (poll, True), (b"debug", False),
+                      (value, True), (b"ok", False)]
+
+
+def test_byte_at_a_time():
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    stream = b"ok\r\n" + msg + b"ok\r\n"
+    parser = FrameParser()
+
+    frames = []
+    for i in range(len(stream)):
+        frames += parser.feed(stream[i:i + 1])
+
+    assert frames == [(b"ok", False), (msg, True), (b"ok", False)]
+
+
+def test_flush():
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    parser = FrameParser()
+
+    parser.feed(b"prompt>")
+    assert parser.flush() == [(b"prompt>", False)]
+
+    # Partial messages are kept until the remainder arrives
+    parser.feed(msg[:4])
+    assert parser.flush() == []
+    assert parser.feed(msg[4:]) == [(msg, True)]
+
+
+def test_receive_buffer():
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    parser = FrameParser(size=32)
+
+    # Fill the buffer in place, leaving a partial message at the end
+    stream = b"ok\r\n" + msg + msg[:6]
+    view = parser.receive_buffer()
+    view[:len(stream)] = stream
+    assert parser.commit(len(stream)) == [(b"ok", False), (msg, True)]
+
+    # The partial message is moved to the front to make room
+    view = parser.receive_buffer()
+    assert len(view) == 32 - 6
+    view[:len(msg) - 6] = msg[6:]
+    assert parser.commit(len(msg) - 6) == [(msg, True)]
+
+
+def test_full_buffer_of_text():
+    parser = FrameParser(size=16)
+
+    frames = parser.feed(b"x" * 20 + b"\n")
+    assert frames == [(b"x" * 16, False), (b"x" * 4, False)]
+
+
+def test_stray_start_code():
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    parser = FrameParser()
+
+    # A start code in text is skipped without swallowing the following data
+    frames = parser.feed(b"val=\xfc\xff\r\n" + msg + b"ok\r\n")
+    assert frames == [(b"val=", False), (b"\xff", False),
+                             (msg, True), (b"ok", False)]
+    assert parser.resyncs == 1
+
+
+def test_invalid_headers():
+    msg = HMTLprotocol.get_value_msg(5, 0, 100)
+    parser = FrameParser()
+
+    bad_version = b"\xfc\x00\x01" + msg[3:]
+    too_long = b"\xfc\x00\x02\xf0" + msg[4:]
+    too_short = HMTLprotocol.get_msg_hdr(HMTLprotocol.MSG_BASE_LEN, 5)
+
+    frames = parser.feed(bad_version + too_long + too_short + msg)
+    assert (msg, True) in frames
+    assert not [data for (data, is_hmtl) in frames if is_hmtl and data != msg]
+    assert parser.resyncs == 3
+
+
+def test_crc():
+    msg = bytearray(HMTLprotocol.get_value_msg(5, 0, 100))
+    parser = FrameParser(check_crc=True)
+
+    assert parser.feed(msg) == []
+    assert parser.crc_errors == 1
+    assert parser.pending() == 0
+
+    msg[1] = HMTLprotocol.msg_crc(msg)
+    assert parser.feed(msg) == [(msg, True)]
@@ -0,0 +1,259 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from hmtl.HMTLSerial import HMTLSerial, HMTLConfigException
+from hmtl.tests.test_InputSelector import PairBuffer
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def poll_response(address, buffer_size=32):
+    """Build the response a module sends to a poll"""
+    fmt = HMTLprotocol.PollHdr.FORMAT
+    length = HMTLprotocol.MSG_BASE_LEN + struct.calcsize(fmt)
+    return HMTLprotocol.get_msg_hdr(length, 0, mtype=HMTLprotocol.MSG_TYPE_POLL,
+                                    flags=HMTLprotocol.MSG_FLAG_ACK) + \
+        struct.pack(fmt, HMTLprotocol.HEADER_MAGIC, 2, 3,
+                    HMTLprotocol.baud_to_byte(115200), 2, 0, 5, address, 1,
+                    buffer_size, 2)
+
+
+class FakeModule(threading.Thread):
+    """
+    Stands in for a module on the remote end of a PairBuffer.  Each HMTL
+    message or terminated command is recorded and answered with "ok", or
+    "fail" if its address is in fail_addresses or the command is in
+    fail_commands.  Polls are also answered with a poll response from the
+    polled address, or from address for a broadcast poll.  Unless running is
+    set the module first sends "ready" after ready_delay, as after a reset.
+    """
+
+    def __init__(self, buff, ready_delay=0.6, ack=True, running=False,
+                 address=5):
+        threading.Thread.__init__(self)
+        self.sock = buff.remote
+        self.ready_delay = ready_delay
+        self.ack = ack
+        self.running = running
+        self.address = address
+        self.fail_addresses = set()
+        self.fail_commands = set()
+        self.received = []
+        self.chunks = []
+        self.daemon = True
+
+    def run(self):
+        if not self.running:
+            time.sleep(self.ready_delay)
+            self.sock.sendall(b"ready\r\n")
+            self.running = True
+
+        data = b""
+        while True:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                break
+            self.chunks.append(chunk)
+            data += chunk
+            while True:
+                if data[:1] == b"\xfc":
+                    # HMTL message
+                    if len(data) < HMTLprotocol.MSG_BASE_LEN or \
+                            len(data) < data[3]:
+                        break
+                    (msg, data) = (data[:data[3]], data[data[3]:])
+                    hdr = HMTLprotocol.MsgHdr.from_data(msg)
+                    failed = hdr.address in self.fail_addresses
+                else:
+                    # Terminated command
+                    terminator = HMTLprotocol.HMTL_TERMINATOR
+                    if terminator not in data:
+                        break
+                    (msg, data) = data.split(terminator, 1)
+                    hdr = None
+                    failed = msg in self.fail_commands
+
+                self.received.append(msg)
+                if not self.ack:
+                    continue
+                if failed:
+                    self.sock.sendall(b"fail\r\n")
+                else:
+                    self.sock.sendall(b"ok\r\n")
+                if hdr and hdr.mtype == HMTLprotocol.MSG_TYPE_POLL:
+                    address = hdr.address
+                    if address == HMTLprotocol.BROADCAST:
+                        address = self.address
+                    self.sock.sendall(poll_response(address))
+
+
+def connect(window=1, ack=True):
+    buff = PairBuffer()
+    module = FakeModule(buff, ack=ack)
+    module.start()
+    return (HMTLSerial(buff, window=window), module)
+
+
+def test_pipelined():
+    (ser, module) = connect(window=4)
+    module.fail_addresses.add(3)
+
+    completed = []
+    futures = [ser.send_async(HMTLprotocol.get_value_msg(address, 0, 1),
+                              False, callback=completed.append)
+               for address in range(0, 10)]
+    assert ser.wait_for_pending(1)
+
+    for (address, future) in enumerate(futures):
+        if address == 3:
+            with pytest.raises(HMTLConfigException):
+                future.result(0)
+        else:
+            assert future.result(0)
+    assert len(completed) == 10
+    assert ser.failures == 1
+    assert len(module.received) == 10
+
+    # Stop-and-wait sends share the same ordering
+    assert ser.send_and_confirm(HMTLprotocol.get_value_msg(1, 0, 1), False)
+
+
+def test_unbuffered():
+    (ser, module) = connect(window=4)
+    for address in range(0, 20):
+        ser.send_async(HMTLprotocol.get_value_msg(address, 0, 1), False)
+    assert ser.wait_for_pending(1)
+
+    # Items only reach subscriptions, leaving nothing in the shared buffer
+    assert len(ser.serial.get_buffer()) == 0
+    assert "overflows" not in ser.serial.get_metrics()
+    assert ser.text is None
+
+    # get_message() returns the items received after its first call
+    assert ser.get_message(0) is None
+    module.sock.sendall(b"hello\r\n")
+    assert ser.get_message(1).data == b"hello"
+
+
+def test_window_limit():
+    (ser, module) = connect(window=2, ack=False)
+
+    ser.send_async(HMTLprotocol.get_value_msg(1, 0, 1), False)
+    ser.send_async(HMTLprotocol.get_value_msg(2, 0, 1), False)
+    with pytest.raises(Exception, match="send window"):
+        ser.send_async(HMTLprotocol.get_value_msg(3, 0, 1), False, timeout=0.1)
+
+    # Abandoning a command frees its place in the window
+    ser.abandon(ser.pending[0][0])
+    future = ser.send_async(HMTLprotocol.get_value_msg(3, 0, 1), False,
+                            timeout=0.1)
+    assert not future.done()
+
+
+def test_write_failure(monkeypatch):
+    (ser, module) = connect(window=1)
+
+    def fail(data):
+        raise OSError("Device disconnected")
+
+    completed = []
+    with monkeypatch.context() as patch:
+        patch.setattr(ser.serial, "write", fail)
+        with pytest.raises(OSError):
+            ser.send_async(HMTLprotocol.get_value_msg(1, 0, 1), False,
+                           callback=completed.append)
+        with pytest.raises(OSError):
+            ser.write_many([HMTLprotocol.get_value_msg(2, 0, 1)])
+
+    # The failed commands hold no pending entry or place in the window
+    assert not ser.pending
+    assert len(completed) == 1
+    assert isinstance(completed[0].exception(), OSError)
+    assert ser.send_async(HMTLprotocol.get_value_msg(3, 0, 1), False,
+                          timeout=0.1).result(1)
+
+
+def test_ready_deadline(monkeypatch):
+    monkeypatch.setattr(HMTLSerial, "MAX_READY_WAIT", 0.8)
+
+    # Ready is seen as soon as it arrives once the module has settled
+    start = time.monotonic()
+    connect()
+    assert time.monotonic() - start < 0.75
+
+    # A ready from before the module settled is ignored
+    buff = PairBuffer()
+    FakeModule(buff, ready_delay=0).start()
+    start = time.monotonic()
+    with pytest.raises(Exception, match="ready signal"):
+        HMTLSerial(buff)
+    assert 0.8 <= time.monotonic() - start < 1.0
+
+
+def test_reattach():
+    # A running module answers the probe immediately
+    buff = PairBuffer()
+    FakeModule(buff, running=True, address=12).start()
+    start = time.monotonic()
+    ser = HMTLSerial(buff, reattach=True)
+    assert time.monotonic() - start < 0.25
+    assert ser.module_info.address == 12
+    assert ser.module_info.buffer_size == 32
+    assert not ser.pending
+
+    # A module that does not answer is waited on as if it had been reset
+    buff = PairBuffer()
+    FakeModule(buff, ready_delay=1.2).start()
+    ser = HMTLSerial(buff, reattach=True)
+    assert ser.module_info is None
+    assert ser.probe().address == 5
+
+
+def test_send_batch():
+    buff = PairBuffer()
+    module = FakeModule(buff, running=True)
+    module.start()
+    ser = HMTLSerial(buff, reattach=True)
+    module.chunks = []
+
+    commands = [(b"start", True)] + \
+               [(bytes([0xFD]) + bytes(range(i, i + 10)), True)
+                for i in range(0, 8)] + \
+               [(b"end", True)]
+    assert ser.send_batch(commands)
+    assert module.received[-len(commands):] == [data for (data, t) in commands]
+
+    # Writes were grouped to fit in the module's reported buffer
+    assert len(module.chunks) < len(commands)
+    assert max(len(chunk) for chunk in module.chunks) <= 32
+    assert not ser.pending
+
+    module.fail_commands.add(commands[3][0])
+    with pytest.raises(HMTLConfigException, match="Command 3"):
+        ser.send_batch(commands)
+    assert not ser.pending
+
+
+def test_pace():
+    buff = PairBuffer()
+    module = FakeModule(buff, running=True)
+    module.start()
+    ser = HMTLSerial(buff, window=8, reattach=True)
+
+    # The module's reported baud and buffer size are used by default
+    pacer = ser.pace()
+    assert pacer.rate == 115200 / 10
+    assert pacer.burst == 32
+
+    ser.pace(baud=9600, buffer_size=32)
+    msgs = [HMTLprotocol.get_value_msg(1, 0, value) for value in range(0, 40)]
+    start = time.monotonic()
+    for msg in msgs:
+        ser.send_async(msg, False)
+    assert ser.wait_for_pending(2)
+    assert time.monotonic() - start >= \
+        (sum(len(msg) for msg in msgs) - 32) / 960.0 - 0.05
+    assert module.received[-len(msgs):] == msgs
+    assert buff.get_metrics()["pacing"]["writes"] == len(msgs)
@@ -0,0 +1,63 @@
+from hmtl.InputBuffer import InputItem
+from hmtl.tests.test_InputSelector import PairBuffer
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def test_subscriptions():
+    buff = PairBuffer()
+    acks = buff.subscribe(InputItem.ACK)
+    polls = buff.subscribe(InputItem.HMTL, mtype=HMTLprotocol.MSG_TYPE_POLL)
+    module = buff.subscribe(InputItem.HMTL, address=7)
+    buff.start()
+
+    poll = HMTLprotocol.get_poll_msg(5)
+    value = HMTLprotocol.get_value_msg(7, 0, 100)
+    buff.remote.sendall(b"debug\r\n" + poll + b"ok\r\ntext\r\n" + value +
+                        b"fail\r\n")
+
+    assert acks.get(wait=1).data == HMTLprotocol.HMTL_CONFIG_ACK
+    assert acks.get(wait=1).data == HMTLprotocol.HMTL_CONFIG_FAIL
+    assert polls.get(wait=1).data == poll
+    assert module.get(wait=1).data == value
+    assert polls.get(wait=0.01) is None
+
+    # Every item is still available from the buffer itself
+    assert [buff.get(wait=1).data for _ in range(0, 6)] == \
+           [b"debug", poll, b"ok", b"text", value, b"fail"]
+
+
+def test_subscription_callback():
+    buff = PairBuffer()
+    received = []
+    subscription = buff.subscribe(InputItem.TEXT, callback=received.append)
+
+    buff.add_frames([(b"one", None), (b"ok", None)])
+    subscription.cancel()
+    buff.add_frames([(b"two", None)])
+
+    assert [item.data for item in received] == [b"one"]
+
+
+def test_lazy_header():
+    msg = HMTLprotocol.get_rgb_msg(300, 1, 255, 0, 0)
+    item = InputItem(msg, 0, True)
+
+    assert item.decoded_hdr is None
+    assert item.mtype == HMTLprotocol.MSG_TYPE_OUTPUT
+    assert item.address == 300
+    assert item.length == HMTLprotocol.MSG_RGB_LEN
+    assert item.decoded_hdr is None
+
+    assert item.hdr.address == 300
+    assert item.hdr is item.decoded_hdr
+    assert not hasattr(item, "__dict__")
+    assert not hasattr(item.hdr, "__dict__")
+
+    # The header's length field does not hide the size of the header
+    assert item.hdr.length == HMTLprotocol.MSG_RGB_LEN
+    assert HMTLprotocol.MsgHdr.length() == HMTLprotocol.MsgHdr.LENGTH
+    assert item.hdr.pack() == msg[:HMTLprotocol.MsgHdr.LENGTH]
+
+    text = InputItem(b"ok", 0)
+    assert text.hdr is None
+    assert text.address is None
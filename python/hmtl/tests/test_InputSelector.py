@@ -0,0 +1,75 @@
+import socket
+
+from hmtl.InputBuffer import InputBuffer
+from hmtl.InputSelector import InputSelector
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+class PairBuffer(InputBuffer):
+    """InputBuffer reading from one end of a socket pair"""
+
+    def __init__(self):
+        InputBuffer.__init__(self, verbose=False)
+        (self.sock, self.remote) = socket.socketpair()
+
+    def get_reader(self):
+        return self.sock
+
+    def read(self, max_read):
+        return self.sock.recv(max_read)
+
+    def write(self, data):
+        self.capture_sent(data)
+        return self.sock.sendall(data)
+
+
+def test_many_buffers():
+    selector = InputSelector()
+    buffers = [PairBuffer() for _ in range(0, 20)]
+    for buff in buffers:
+        selector.register(buff)
+        buff.start()
+    selector.start()
+
+    for (i, buff) in enumerate(buffers):
+        buff.remote.sendall(b"ready\r\n" + HMTLprotocol.get_poll_msg(i))
+
+    for (i, buff) in enumerate(buffers):
+        assert not buff.is_alive()
+        assert buff.get(wait=1).data == b"ready"
+        item = buff.get(wait=1)
+        assert item.is_hmtl
+        assert item.hdr.address == i
+
+
+def test_idle_flush():
+    selector = InputSelector()
+    buff = PairBuffer()
+    selector.register(buff)
+    selector.start()
+
+    buff.remote.sendall(b"prompt>")
+    assert buff.get(wait=1).data == b"prompt>"
+
+    buff.stop()
+    assert buff not in selector.fds
+
+
+def test_metrics():
+    selector = InputSelector()
+    buff = PairBuffer()
+    selector.register(buff)
+    selector.start()
+
+    msg = HMTLprotocol.get_poll_msg(1)
+    buff.remote.sendall(b"ok\r\n" + msg + b"\xfc\x00\x07\r\n")
+    for _ in range(0, 3):
+        assert buff.get(wait=1) is not None
+
+    metrics = buff.get_metrics()
+    assert metrics["bytes"] == 4 + len(msg) + 5
+    assert metrics["hmtl_frames"] == 1
+    assert metrics["text_frames"] == 2
+    assert metrics["resyncs"] == 1
+    assert metrics["max_depth"] >= 1
+    assert sum(count for (bound, count) in metrics["histogram"]) == 2
@@ -0,0 +1,48 @@
+import json
+import os
+
+from hmtl.LogSink import JSONLinesSink, BinaryLogSink, read_binary_log
+from hmtl.TimedLogger import TimedLogger, LogWriter
+
+
+def test_json_lines(tmp_path):
+    filename = str(tmp_path / "log.json")
+    writer = LogWriter(sinks=[JSONLinesSink(filename)])
+    writer.start()
+
+    logger = TimedLogger(writer=writer, component="test")
+    logger.logf("value %d", 5, timestamp=10.0, color=TimedLogger.RED)
+    logger.log("raw", timestamp=11.0, data=b"\xfc\x00")
+    writer.close()
+
+    with open(filename) as f:
+        records = [json.loads(line) for line in f]
+    assert records == [
+        {"time": 10.0, "component": "test", "text": "value 5"},
+        {"time": 11.0, "component": "test", "text": "raw", "data": "fc00"},
+    ]
+
+
+def test_binary_rotation(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    writer = LogWriter(sinks=[BinaryLogSink(filename, max_bytes=200,
+                                            backups=2)])
+    writer.start()
+
+    logger = TimedLogger(writer=writer, component="test")
+    for i in range(0, 20):
+        logger.logf("line %d", i, timestamp=float(i), data=bytes([i]))
+    writer.close()
+
+    assert os.path.exists(filename + ".1")
+    assert os.path.exists(filename + ".2")
+    assert not os.path.exists(filename + ".3")
+    for name in (filename, filename + ".1", filename + ".2"):
+        assert os.path.getsize(name) <= 200
+
+    records = list(read_binary_log(filename))
+    (timestamp, component, text, data) = records[-1]
+    assert (timestamp, component, text, data) == (19.0, "test", "line 19",
+                                                  b"\x13")
+    older = list(read_binary_log(filename + ".1"))
+    assert older[-1][2] == "line %d" % (19 - len(records))
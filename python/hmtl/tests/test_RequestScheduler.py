@@ -0,0 +1,75 @@
+import threading
+import time
+
+from hmtl.RequestScheduler import RequestScheduler
+
+
+def test_round_robin():
+    scheduler = RequestScheduler()
+    for i in range(0, 4):
+        scheduler.put("a", "a%d" % i)
+    scheduler.put("b", "b0")
+    scheduler.put("c", "c0")
+    scheduler.put("b", "b1")
+
+    order = [scheduler.get(0)[1] for _ in range(0, 7)]
+    assert order == ["a0", "b0", "c0", "a1", "b1", "a2", "a3"]
+    assert scheduler.get(0) == (None, None)
+
+
+def test_backpressure():
+    scheduler = RequestScheduler(limit=2)
+    assert scheduler.put("a", 1)
+    assert scheduler.put("a", 2)
+    assert not scheduler.put("a", 3, timeout=0.05)
+
+    # Other clients are unaffected by a full queue
+    assert scheduler.put("b", 1, timeout=0.05)
+
+    # A blocked producer continues once its request is consumed
+    threading.Timer(0.05, scheduler.get).start()
+    start = time.monotonic()
+    assert scheduler.put("a", 3, timeout=1)
+    assert time.monotonic() - start < 0.5
+
+
+def test_remove_and_close():
+    scheduler = RequestScheduler()
+    scheduler.put("a", 1)
+    scheduler.put("b", 2)
+    scheduler.remove("a")
+    assert len(scheduler) == 1
+    assert scheduler.get(0) == ("b", 2)
+
+    threading.Timer(0.05, scheduler.close).start()
+    assert scheduler.get() == (None, None)
+    assert not scheduler.put("a", 1)
+
+
+def test_coalesce():
+    superseded = []
+    scheduler = RequestScheduler(
+        superseded=lambda client, request: superseded.append((client,
+                                                              request)))
+    scheduler.put("a", "rgb1", key=(1, 0))
+    scheduler.put("a", "other1", key=(2, 0))
+    scheduler.put("a", "rgb2", key=(1, 0))
+
+    # Requests without a key are barriers to later requests with keys
+    scheduler.put("a", "program")
+    scheduler.put("a", "rgb3", key=(1, 0))
+    scheduler.put("a", "rgb4", key=(1, 0))
+
+    # Keys are per client
+    scheduler.put("b", "rgb1", key=(1, 0))
+
+    order = [scheduler.get(0) for _ in range(0, 5)]
+    assert order == [("a", "rgb2"), ("b", "rgb1"), ("a", "other1"),
+                     ("a", "program"), ("a", "rgb4")]
+    assert scheduler.coalesced == 2
+    assert superseded == [("a", "rgb1"), ("a", "rgb3")]
+
+    # A handled request is not replaced
+    scheduler.put("a", "rgb5", key=(1, 0))
+    assert scheduler.get(0) == ("a", "rgb5")
+    assert len(scheduler) == 0
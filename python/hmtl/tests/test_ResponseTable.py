@@ -0,0 +1,61 @@
+import struct
+import time
+
+from hmtl.InputBuffer import InputItem
+from hmtl.ResponseTable import ResponseTable
+from hmtl.tests.test_HMTLSerial import poll_response
+from hmtl.tests.test_InputSelector import PairBuffer
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def dump_response(address, part, more=False):
+    flags = HMTLprotocol.MSG_FLAG_MORE_DATA if more else 0
+    return HMTLprotocol.get_msg_hdr(HMTLprotocol.MSG_BASE_LEN + 1, address,
+                                    mtype=HMTLprotocol.MSG_TYPE_DUMPCONFIG,
+                                    flags=flags) + struct.pack("<B", part)
+
+
+def test_concurrent_requests():
+    table = ResponseTable(PairBuffer())
+    poll_a = table.expect(7, HMTLprotocol.MSG_TYPE_POLL)
+    dump = table.expect(8, HMTLprotocol.MSG_TYPE_DUMPCONFIG)
+    poll_b = table.expect(9, HMTLprotocol.MSG_TYPE_POLL)
+
+    # Responses arriving interleaved and out of order reach their requesters
+    table.dispatch(InputItem.from_data(poll_response(9)))
+    table.dispatch(InputItem.from_data(dump_response(8, 0, more=True)))
+    table.dispatch(InputItem.from_data(poll_response(7)))
+    table.dispatch(InputItem.from_data(dump_response(8, 1, more=True)))
+    assert not dump.done()
+    table.dispatch(InputItem.from_data(dump_response(8, 2)))
+
+    assert HMTLprotocol.msg_to_headers(poll_a.get(0).data)[-1].address == 7
+    assert HMTLprotocol.msg_to_headers(poll_b.get(0).data)[-1].address == 9
+    assert [dump.get(0).data[-1] for _ in range(0, 3)] == [0, 1, 2]
+    assert poll_a.done() and poll_b.done() and dump.done()
+    assert len(table) == 0
+
+    # Nobody was waiting for this one
+    table.dispatch(InputItem.from_data(poll_response(7)))
+    assert table.get_unmatched(0) is not None
+
+
+def test_broadcast_and_expiry():
+    table = ResponseTable(PairBuffer(), lifetime=0.1)
+    poll = table.expect(HMTLprotocol.BROADCAST, HMTLprotocol.MSG_TYPE_POLL)
+
+    # Any number of modules may answer a broadcast
+    for address in (1, 2, 3):
+        table.dispatch(InputItem.from_data(poll_response(address)))
+    assert len(table) == 1
+    assert len(poll.responses) == 3
+
+    # Responses that do not identify the module go to the oldest request
+    dump = table.expect(4, HMTLprotocol.MSG_TYPE_DUMPCONFIG)
+    table.dispatch(InputItem.from_data(dump_response(0, 0)))
+    assert dump.get(0) is not None
+
+    time.sleep(0.15)
+    table.dispatch(InputItem.from_data(poll_response(1)))
+    assert table.get_unmatched(0) is not None
+    assert len(table) == 0
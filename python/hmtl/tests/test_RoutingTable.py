@@ -0,0 +1,22 @@
+from hmtl.RoutingTable import RoutingTable
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def test_routes():
+    table = RoutingTable(["a", "b", "c"])
+    assert table.route(5) == ["a", "b", "c"]
+    assert table.route(HMTLprotocol.BROADCAST) == ["a", "b", "c"]
+
+    assert table.learn(5, "b")
+    assert not table.learn(5, "b")
+    assert table.route(5) == ["b"]
+
+    # A module that moves is followed to its new link
+    assert table.learn(5, "c")
+    assert table.route(5) == ["c"]
+
+    # Static routes take precedence over learned ones
+    table.add_route(5, "a")
+    table.add_route(6, "b")
+    assert table.route(5) == ["a"]
+    assert table.get_routes() == {5: "a", 6: "b"}
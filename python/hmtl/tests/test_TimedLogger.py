@@ -0,0 +1,70 @@
+import io
+
+from hmtl.TimedLogger import TimedLogger, LogWriter, Lazy
+
+
+class Counted:
+    """Argument that counts how many times it has been formatted"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return "counted"
+
+
+def test_queued_writer():
+    stream = io.StringIO()
+    writer = LogWriter(stream)
+    writer.start()
+
+    logger = TimedLogger(start_time=100.0, writer=writer)
+    logger.logf("value %d %s", 5, Lazy(lambda: "lazy"), timestamp=101.5)
+    logger.log("100% literal", timestamp=102.0)
+    logger.logf("bad %d", "format")
+    assert writer.flush(1)
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    assert "[1.500] " in lines[0] and "value 5 lazy" in lines[0]
+    assert "100% literal" in lines[1]
+    assert "Log formatting failed" in lines[2]
+
+
+def test_filtered_not_formatted():
+    stream = io.StringIO()
+    writer = LogWriter(stream)
+    writer.start()
+
+    arg = Counted()
+    logger = TimedLogger(writer=writer, level=TimedLogger.WARNING)
+    logger.logf("%s", arg)
+    logger.logf("%s", arg, level=TimedLogger.DEBUG)
+    logger.disable()
+    logger.logf("%s", arg, level=TimedLogger.ERROR)
+    assert writer.flush(1)
+    assert arg.count == 0
+    assert stream.getvalue() == ""
+
+    logger.enable()
+    logger.logf("%s", arg, level=TimedLogger.ERROR)
+    assert writer.flush(1)
+    assert arg.count == 1
+
+
+def test_writer_limit():
+    stream = io.StringIO()
+    writer = LogWriter(stream, limit=3)
+
+    # Lines queued beyond the limit displace the oldest ones
+    logger = TimedLogger(writer=writer)
+    for index in range(0, 5):
+        logger.log("line %d" % index)
+    assert writer.dropped == 2
+
+    writer.start()
+    assert writer.flush(1)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    assert "line 2" in lines[0] and "line 4" in lines[2]
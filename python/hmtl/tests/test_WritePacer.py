@@ -0,0 +1,40 @@
+import time
+
+from hmtl.WritePacer import WritePacer
+
+
+def test_burst_then_rate():
+    pacer = WritePacer(1000, 100)
+
+    # A burst up to the module's buffer is written immediately
+    assert pacer.reserve(60) == 0
+    assert pacer.reserve(40) == 0
+
+    # Beyond that writes are held to the link's rate
+    assert abs(pacer.reserve(50) - 0.05) < 0.01
+    assert abs(pacer.reserve(50) - 0.1) < 0.01
+
+    # Writes larger than the buffer wait for it to empty
+    pacer = WritePacer(1000, 100)
+    assert pacer.reserve(500) == 0
+    assert abs(pacer.reserve(10) - 0.41) < 0.01
+
+
+def test_sustained_throughput():
+    pacer = WritePacer.from_link(9600, 32)
+    assert pacer.rate == 960
+    pacer.sample()
+
+    start = time.monotonic()
+    for _ in range(0, 20):
+        pacer.acquire(24)
+    elapsed = time.monotonic() - start
+
+    # 480 bytes less the initial burst at 960 bytes per second
+    assert 0.4 < elapsed < 0.6
+    metrics = pacer.sample()
+    assert metrics["writes"] == 20
+    assert metrics["delayed"] > 0
+    # The initial burst allows slightly more than the rate over the sample
+    assert 0.8 < metrics["utilization"] < 1.1
+    assert metrics["max_delay"] >= metrics["mean_delay"] > 0
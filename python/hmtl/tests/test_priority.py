@@ -0,0 +1,42 @@
+import pytest
+
+from hmtl.InputBuffer import InputItem
+from hmtl.priority import PriorityRule, LatencyMetrics, classify, \
+    PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def test_rules():
+    rules = [PriorityRule.parse("high:address=64"),
+             PriorityRule.parse("high:address=10,output=2"),
+             PriorityRule.parse("low:type=POLL")]
+    assert str(rules[1]) == "high:address=10,output=2"
+
+    def priority(msg):
+        return classify(rules, InputItem.from_data(msg))
+
+    assert priority(HMTLprotocol.get_value_msg(64, 0, 1)) == PRIORITY_HIGH
+    assert priority(HMTLprotocol.get_poll_msg(64)) == PRIORITY_HIGH
+    assert priority(HMTLprotocol.get_rgb_msg(10, 2, 1, 2, 3)) == PRIORITY_HIGH
+    assert priority(HMTLprotocol.get_rgb_msg(10, 1, 1, 2, 3)) == PRIORITY_NORMAL
+    assert priority(HMTLprotocol.get_poll_msg(10)) == PRIORITY_LOW
+    assert priority(b"text") == PRIORITY_NORMAL
+
+    with pytest.raises(Exception, match="Unknown priority"):
+        PriorityRule.parse("urgent:address=1")
+    with pytest.raises(Exception, match="field"):
+        PriorityRule.parse("high:colour=1")
+
+
+def test_latency_metrics():
+    metrics = LatencyMetrics()
+    metrics.record_sent(0.001)
+    metrics.record_sent(0.003)
+    metrics.record_acked(0.004)
+    sample = metrics.sample()
+    assert sample["sent"] == 2
+    assert abs(sample["sent_mean"] - 0.002) < 1e-9
+    assert sample["sent_max"] == 0.003
+    assert sample["acked"] == 1
+    assert dict(sample["histogram"])[0.005] == 1
+    assert "2 sent" in LatencyMetrics.format(sample)
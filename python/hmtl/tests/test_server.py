@@ -0,0 +1,384 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from hmtl.client import HMTLClient
+from hmtl.HMTLSerial import HMTLSerial
+from hmtl.priority import PriorityRule
+from hmtl.server import HMTLServer, ClientConnection, SERVER_ACK
+from hmtl.tests.test_HMTLSerial import FakeModule
+from hmtl.tests.test_InputSelector import PairBuffer
+import hmtl.HMTLprotocol as HMTLprotocol
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def connect_client(port):
+    deadline = time.monotonic() + 2
+    while True:
+        try:
+            return HMTLClient("localhost", port, logger=False)
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    buff = PairBuffer()
+    module = FakeModule(buff, running=True)
+    module.start()
+    ser = HMTLSerial(buff, window=8, reattach=True)
+
+    port = free_port()
+    server = HMTLServer(ser, ("localhost", port), logger=False)
+    thread = threading.Thread(target=server.listen)
+    thread.daemon = True
+    thread.start()
+
+    server.module = module
+    server.port = port
+    yield server
+    server.close()
+
+
+def test_multiple_clients(server):
+    clients = [connect_client(server.port) for _ in range(0, 4)]
+
+    def send(client, address):
+        for value in range(0, 10):
+            msg = HMTLprotocol.get_value_msg(address, 0, value)
+            assert client.send_and_ack(msg, timeout=2) == [None, None]
+
+    threads = [threading.Thread(target=send, args=(client, address))
+               for (address, client) in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(server.module.received) == 1 + 40
+    assert len(server.clients) == 4
+
+    # Each client's messages reached the module in the order sent
+    for address in range(0, 4):
+        values = [msg[-2] for msg in server.module.received
+                  if msg[0] == 0xFC and
+                  HMTLprotocol.MsgHdr.from_data(msg).address == address]
+        assert values == list(range(0, 10))
+
+    # Failures are reported to the client that sent the message
+    server.module.fail_addresses.add(9)
+    with pytest.raises(Exception, match="failed to forward"):
+        clients[0].send_and_ack(HMTLprotocol.get_value_msg(9, 0, 1), timeout=2)
+    assert clients[1].send_and_ack(HMTLprotocol.get_value_msg(1, 0, 1),
+                                   timeout=2) == [None, None]
+
+    clients[0].close()
+    deadline = time.monotonic() + 1
+    while len(server.clients) > 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(server.clients) == 3
+
+
+def test_data_request(server):
+    client = connect_client(server.port)
+    (messages, headers) = client.send_and_ack(HMTLprotocol.get_poll_msg(5),
+                                              expect_response=True, timeout=2)
+    assert headers[0][-1].address == 5
+
+
+def test_stream(server):
+    client = connect_client(server.port)
+    for value in range(0, 50):
+        client.stream(HMTLprotocol.get_value_msg(1, 0, value))
+
+    # A regular message is acknowledged after the streamed ones before it
+    assert client.send_and_ack(HMTLprotocol.get_value_msg(2, 0, 0),
+                               timeout=2) == [None, None]
+    assert len(server.module.received) == 1 + 50 + 1
+
+    server.module.fail_addresses.add(3)
+    client.stream(HMTLprotocol.get_value_msg(3, 0, 1))
+    client.send_and_ack(HMTLprotocol.get_value_msg(2, 0, 0), timeout=2)
+    assert client.check_stream() == 1
+    assert client.stream_errors == 1
+    assert client.stream_notices[-1][0] == "stream-error"
+
+
+def test_batch(server):
+    client = connect_client(server.port)
+    server.module.fail_addresses.add(3)
+    server.module.chunks = []
+
+    msgs = [HMTLprotocol.get_rgb_msg(address, 0, 1, 2, 3)
+            for address in range(0, 6)]
+    assert client.send_batch(msgs, timeout=2) == \
+        [True, True, True, False, True, True]
+    assert server.module.received[-6:] == msgs
+
+    # The batch reached the module as a single write
+    assert server.module.chunks == [b"".join(msgs)]
+
+    assert client.send_batch([], timeout=2) == []
+
+
+def test_concurrent_polls(server):
+    clients = [connect_client(server.port) for _ in range(0, 4)]
+    results = {}
+
+    def poll(client, address):
+        results[address] = []
+        for _ in range(0, 5):
+            (messages, headers) = client.send_and_ack(
+                HMTLprotocol.get_poll_msg(address), expect_response=True,
+                timeout=2)
+            results[address].append(headers[0][-1].address)
+
+    threads = [threading.Thread(target=poll, args=(client, 20 + index))
+               for (index, client) in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # Each client received the responses to its own polls
+    for index in range(0, 4):
+        assert results[20 + index] == [20 + index] * 5
+    assert len(server.pending_responses) == 0
+
+
+@pytest.mark.filterwarnings(
+    "ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_bad_messages(server, monkeypatch):
+    client = connect_client(server.port)
+
+    # Messages too short for a header are rejected
+    with pytest.raises(Exception, match="failed to forward"):
+        client.send_and_ack(b"\xfc\x00\x02", timeout=2)
+    client.stream(b"\xfc")
+    assert client.send_and_ack(HMTLprotocol.get_value_msg(1, 0, 1),
+                               timeout=2) == [None, None]
+    assert client.check_stream() == 1
+
+    # A client whose thread fails is still removed
+    def fail(*args, **kwargs):
+        raise Exception("Failed to submit")
+    monkeypatch.setattr(server, "submit", fail)
+    client.send(HMTLprotocol.get_value_msg(1, 0, 1))
+    deadline = time.monotonic() + 2
+    while server.clients and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not server.clients
+
+def test_coalesce(server):
+    server.coalesce = True
+    # Hold the link to a rate well below that of the client
+    server.ser.pace(baud=9600, buffer_size=16)
+    client = connect_client(server.port)
+
+    for value in range(0, 100):
+        client.stream(HMTLprotocol.get_value_msg(1, 0, value))
+        client.stream(HMTLprotocol.get_rgb_msg(1, 1, value, 0, 0))
+    client.stream(HMTLprotocol.get_poll_msg(1))
+    client.stream(HMTLprotocol.get_value_msg(1, 0, 200))
+    assert client.send_and_ack(HMTLprotocol.get_value_msg(2, 0, 0),
+                               timeout=5) == [None, None]
+
+    received = [msg for msg in server.module.received
+                if HMTLprotocol.MsgHdr.from_data(msg).address == 1]
+    assert len(received) < 100
+    assert server.links[0].scheduler.coalesced > 100
+
+    # Superseded messages are counted and the client is not told of them
+    metrics = server.get_latency_metrics()["normal"]
+    assert metrics["superseded"] == server.links[0].scheduler.coalesced
+    assert client.check_stream() == 0
+    assert not client.conn.poll(0)
+
+    # The latest message for each output was sent before the poll, in the
+    # order of each output's messages, and nothing was moved across the poll.
+    # How the two outputs interleave depends on when the link was free.
+    mtypes = [HMTLprotocol.MsgHdr.from_data(msg).mtype for msg in received]
+    poll = mtypes.index(HMTLprotocol.MSG_TYPE_POLL)
+    values = [msg[-2] for msg in received[:poll]
+              if msg[HMTLprotocol.MsgHdr.LENGTH] ==
+              HMTLprotocol.CONFIG_TYPES["value"]]
+    colors = [msg[-3] for msg in received[:poll]
+              if msg[HMTLprotocol.MsgHdr.LENGTH] ==
+              HMTLprotocol.CONFIG_TYPES["rgb"]]
+    for sent in (values, colors):
+        assert sent == sorted(sent)
+        assert sent[-1] == 99
+    assert received[poll + 1:] == [HMTLprotocol.get_value_msg(1, 0, 200)]
+
+
+def test_priority(server):
+    server.priorities = [PriorityRule.parse("high:address=64")]
+    # Hold the link to a rate well below that of the client
+    server.ser.pace(baud=9600, buffer_size=16)
+    client = connect_client(server.port)
+    trigger = connect_client(server.port)
+
+    msgs = [HMTLprotocol.get_rgb_msg(1, 0, value, 0, 0)
+            for value in range(0, 60)]
+    for msg in msgs:
+        client.stream(msg)
+    time.sleep(0.05)
+
+    # The trigger is forwarded ahead of the queued animation traffic
+    fire = HMTLprotocol.get_value_msg(64, 0, 1)
+    assert trigger.send_and_ack(fire, timeout=2) == [None, None]
+    assert server.module.received.index(fire) < 1 + 20
+    assert client.send_and_ack(HMTLprotocol.get_value_msg(2, 0, 0),
+                               timeout=5) == [None, None]
+
+    latency = server.get_latency_metrics()
+    assert latency["high"]["acked"] == 1
+    assert latency["normal"]["sent"] == 61
+    assert latency["high"]["sent_max"] < latency["normal"]["sent_max"]
+
+    # The server's own messages, such as the device scan's polls, are queued
+    # with the clients' at the priority of the rule they match
+    server.priorities.append(PriorityRule.parse("low:type=POLL"))
+    assert server.send_data(HMTLprotocol.get_poll_msg(1), "scanner")
+    assert server.get_latency_metrics()["low"]["sent"] == 1
+
+
+@pytest.fixture
+def multi_server():
+    modules = []
+    devices = []
+    for address in (10, 20):
+        buff = PairBuffer()
+        module = FakeModule(buff, running=True, address=address)
+        module.start()
+        modules.append(module)
+        devices.append(HMTLSerial(buff, window=8, reattach=True))
+
+    port = free_port()
+    server = HMTLServer(devices, ("localhost", port), logger=False,
+                        routes={40: 1})
+    thread = threading.Thread(target=server.listen)
+    thread.daemon = True
+    thread.start()
+
+    server.modules = modules
+    server.port = port
+    yield server
+    server.close()
+
+
+def test_routing(multi_server):
+    client = connect_client(multi_server.port)
+    (link0, link1) = multi_server.links
+    (module0, module1) = multi_server.modules
+
+    # Broadcasts go to every link, and the poll responses teach the routes
+    client.send_and_ack(HMTLprotocol.get_poll_msg(HMTLprotocol.BROADCAST),
+                        timeout=2)
+    deadline = time.monotonic() + 1
+    while len(multi_server.routes.get_routes()) < 3 and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert multi_server.routes.get_routes() == {10: link0, 20: link1,
+                                                40: link1}
+
+    for module in multi_server.modules:
+        module.received = []
+    for address in (10, 20, 40, 30):
+        client.send_and_ack(HMTLprotocol.get_value_msg(address, 0, 1),
+                            timeout=2)
+    addresses = [[HMTLprotocol.MsgHdr.from_data(msg).address
+                  for msg in module.received] for module in (module0, module1)]
+
+    # Unicasts only reach the routed link, unknown addresses go to every link
+    assert addresses == [[10, 30], [20, 40, 30]]
+
+    # A failure on any link is reported to the client
+    module1.fail_addresses.add(HMTLprotocol.BROADCAST)
+    with pytest.raises(Exception, match="failed to forward"):
+        client.send_and_ack(HMTLprotocol.get_value_msg(
+            HMTLprotocol.BROADCAST, 0, 1), timeout=2)
+    assert client.send_batch([HMTLprotocol.get_value_msg(10, 0, 1),
+                              HMTLprotocol.get_value_msg(
+                                  HMTLprotocol.BROADCAST, 0, 1)],
+                             timeout=2) == [True, False]
+
+
+def test_links_concurrent(multi_server):
+    for link in multi_server.links:
+        link.ser.pace(baud=9600, buffer_size=16)
+    client = connect_client(multi_server.port)
+    multi_server.routes.learn(10, multi_server.links[0])
+    multi_server.routes.learn(20, multi_server.links[1])
+
+    start = time.monotonic()
+    for value in range(0, 30):
+        for address in (10, 20):
+            client.stream(HMTLprotocol.get_value_msg(address, 0, value))
+    for address in (10, 20):
+        client.send_and_ack(HMTLprotocol.get_value_msg(address, 0, 0),
+                            timeout=5)
+    elapsed = time.monotonic() - start
+
+    # Each link carries half the traffic at the same time as the other
+    size = len(HMTLprotocol.get_value_msg(10, 0, 0))
+    per_link = 31 * size / 960.0
+    assert elapsed < 1.5 * per_link
+    assert client.check_stream() == 0
+
+
+class StalledConnection:
+    """A client connection whose writes block until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.closed = threading.Event()
+        self.sent = []
+
+    def send(self, data):
+        self.release.wait()
+        self.sent.append(data)
+
+    def recv(self):
+        self.closed.wait()
+        raise EOFError()
+
+    def close(self):
+        self.release.set()
+        self.closed.set()
+
+
+def test_slow_client(server, monkeypatch):
+    monkeypatch.setattr(ClientConnection, "OUTBOUND_LIMIT", 3)
+
+    # Replying to a client that is not reading does not block the caller
+    conn = StalledConnection()
+    client = ClientConnection(server, conn, 99)
+    client.start()
+    start = time.monotonic()
+    for _ in range(0, 3):
+        assert client.send(SERVER_ACK)
+    assert time.monotonic() - start < 0.1
+
+    conn.release.set()
+    deadline = time.monotonic() + 1
+    while len(conn.sent) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert conn.sent == [SERVER_ACK] * 3
+
+    # A client whose replies back up is disconnected
+    conn = StalledConnection()
+    client = ClientConnection(server, conn, 100)
+    client.start()
+    results = [client.send(SERVER_ACK) for _ in range(0, 6)]
+    assert results[-1] is False
+    assert client.closed
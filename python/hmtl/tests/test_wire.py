@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from hmtl.client import HMTLClient
+from hmtl.HMTLSerial import HMTLSerial
+from hmtl.server import HMTLServer
+from hmtl.tests.test_HMTLSerial import FakeModule
+from hmtl.tests.test_InputSelector import PairBuffer
+from hmtl.wire import WireListener, encode, decode, FRAME_HDR, OP_BATCH
+import hmtl.HMTLprotocol as HMTLprotocol
+import hmtl.server as server
+
+
+@pytest.mark.parametrize("obj,server_side", [
+    (server.SERVER_ACK, True),
+    (server.SERVER_NACK, True),
+    (server.SERVER_DATA_REQ, False),
+    (server.SERVER_EXIT, False),
+    (b"\xfc\x00\x02", False),
+    (b"\xfc\x00\x02", True),
+    (None, True),
+    ((server.SERVER_STREAM, b"\xfc\x01"), False),
+    ((server.SERVER_STREAM_ERROR, b"\xfc\x01"), True),
+    ((server.SERVER_BATCH, [b"\xfc\x01", b"", b"\xfc\x02\x03"]), False),
+    ((server.SERVER_BATCH_ACK, [True, False, True]), True),
+])
+def test_round_trip(obj, server_side):
+    assert decode(*encode(obj, server_side)) == obj
+
+
+@pytest.mark.parametrize("opcode,payload", [
+    (OP_BATCH, b"\x05\x00\xfc\x01"),
+    (OP_BATCH, b"\x02\x00\xfc\x01\x05"),
+    (99, b""),
+])
+def test_decode_malformed(opcode, payload):
+    with pytest.raises(server.MessageError):
+        decode(opcode, payload)
+
+
+@pytest.fixture
+def wire_server():
+    buff = PairBuffer()
+    module = FakeModule(buff, running=True)
+    module.start()
+    ser = HMTLSerial(buff, window=8, reattach=True)
+
+    listener = WireListener(("localhost", 0))
+    port = listener.address[1]
+    wire_server = HMTLServer(ser, ("localhost", port), logger=False,
+                             listener=listener)
+    thread = threading.Thread(target=wire_server.listen)
+    thread.daemon = True
+    thread.start()
+
+    wire_server.module = module
+    wire_server.port = port
+    yield wire_server
+    wire_server.close()
+
+
+def test_wire_client(wire_server):
+    client = HMTLClient("localhost", wire_server.port, logger=False, wire=True)
+
+    msg = HMTLprotocol.get_value_msg(1, 0, 7)
+    assert client.send_and_ack(msg, timeout=2) == [None, None]
+    assert wire_server.module.received[-1] == msg
+
+    (messages, headers) = client.send_and_ack(HMTLprotocol.get_poll_msg(5),
+                                              expect_response=True, timeout=2)
+    assert headers[0][-1].address == 5
+
+    wire_server.module.fail_addresses.add(3)
+    msgs = [HMTLprotocol.get_rgb_msg(address, 0, 1, 2, 3)
+            for address in range(2, 5)]
+    assert client.send_batch(msgs, timeout=2) == [True, False, True]
+
+    client.stream(HMTLprotocol.get_value_msg(3, 0, 1))
+    client.send_and_ack(msg, timeout=2)
+    assert client.check_stream() == 1
+    assert client.stream_notices[-1][0] == server.SERVER_STREAM_ERROR
+
+    # Replies carry the id of the request they answer
+    client.send(msg)
+    request_id = client.conn.next_request_id - 1
+    assert client.conn.poll(2)
+    assert client.conn.recv() == server.SERVER_ACK
+    assert client.conn.last_request_id == request_id
+
+    # An empty message is rejected without closing the connection
+    client.send(b"")
+    assert client.conn.poll(2)
+    assert client.conn.recv() == server.SERVER_NACK
+    assert client.send_and_ack(msg, timeout=2) == [None, None]
+
+    # Malformed frames are rejected without dropping the connection
+    client.conn.sock.sendall(FRAME_HDR.pack(OP_BATCH, 500, 3) + b"\x05\x00\xfc")
+    assert client.conn.poll(2)
+    assert client.conn.recv() == server.SERVER_NACK
+    assert client.conn.last_request_id == 500
+    assert client.send_and_ack(msg, timeout=2) == [None, None]
+    assert len(wire_server.clients) == 1
+
+    # A batch containing an empty message is rejected as a whole
+    with pytest.raises(Exception, match="rejected batch"):
+        client.send_batch([msg, b""], timeout=2)
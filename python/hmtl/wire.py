@@ -0,0 +1,229 @@
+################################################################################
+# Author: Adam Phelps
+# License: MIT
+# Copyright: 2015
+#
+# Compact binary protocol between HMTL clients and the command server
+#
+################################################################################
+
+"""
+Each frame on the wire is a 5 byte header followed by the payload:
+
+  | opcode (1B) | request id (2B) | payload length (2B) | payload ... |
+
+All values are little-endian.  Replies from the server carry the request id
+of the request they answer, so several requests may be in flight at once.
+
+  Opcode           Sent by  Payload
+  OP_MSG           client   HMTL message to forward, answered by OP_ACK/OP_NACK
+  OP_ACK           server   none
+  OP_NACK          server   none
+  OP_DATA_REQ      client   none, answered by OP_DATA
+  OP_DATA          server   response message, empty if there was none
+  OP_EXIT          client   none, answered by OP_ACK before the server exits
+  OP_STREAM        client   HMTL message to forward without acknowledgement
+  OP_STREAM_DROP   server   streamed message that was dropped
+  OP_STREAM_ERROR  server   streamed message the module did not acknowledge
+  OP_BATCH         client   messages each prefixed by a 2 byte length,
+                            answered by OP_BATCH_ACK
+  OP_BATCH_ACK     server   one byte per message, 1 if it was acknowledged
+
+WireListener and WireConnection present the same interface as the
+multiprocessing.connection objects, translating between frames and the
+values used by hmtl.server and hmtl.client.
+"""
+
+import select
+import socket
+import struct
+import time
+
+import hmtl.server as server
+
+FRAME_HDR = struct.Struct("<BHH")
+BATCH_LEN = struct.Struct("<H")
+
+OP_MSG = 1
+OP_ACK = 2
+OP_NACK = 3
+OP_DATA_REQ = 4
+OP_DATA = 5
+OP_EXIT = 6
+OP_STREAM = 7
+OP_STREAM_DROP = 8
+OP_STREAM_ERROR = 9
+OP_BATCH = 10
+OP_BATCH_ACK = 11
+
+# Opcodes of requests and replies with no payload
+SENTINELS = {
+    server.SERVER_ACK: OP_ACK,
+    server.SERVER_NACK: OP_NACK,
+    server.SERVER_DATA_REQ: OP_DATA_REQ,
+    server.SERVER_EXIT: OP_EXIT,
+}
+SENTINEL_VALUES = dict((op, value) for (value, op) in SENTINELS.items())
+
+# Opcodes of (kind, msg) tuples
+MSG_TUPLES = {
+    server.SERVER_STREAM: OP_STREAM,
+    server.SERVER_STREAM_DROP: OP_STREAM_DROP,
+    server.SERVER_STREAM_ERROR: OP_STREAM_ERROR,
+}
+MSG_TUPLE_KINDS = dict((op, kind) for (kind, op) in MSG_TUPLES.items())
+
+
+def encode(obj, server_side):
+    """Return the (opcode, payload) for a value sent by a client or server"""
+    if isinstance(obj, str):
+        return (SENTINELS[obj], b"")
+    if obj is None:
+        return (OP_DATA, b"")
+    if isinstance(obj, (bytes, bytearray)):
+        return (OP_DATA if server_side else OP_MSG, bytes(obj))
+
+    (kind, payload) = obj
+    if kind in MSG_TUPLES:
+        return (MSG_TUPLES[kind], bytes(payload))
+    if kind == server.SERVER_BATCH:
+        return (OP_BATCH, b"".join(BATCH_LEN.pack(len(msg)) + bytes(msg)
+                                   for msg in payload))
+    if kind == server.SERVER_BATCH_ACK:
+        return (OP_BATCH_ACK, bytes(1 if status else 0 for status in payload))
+    raise Exception("Unable to encode %s" % (obj,))
+
+
+def decode(opcode, payload):
+    """
+    Return the value represented by a frame, raising server.MessageError if
+    it is malformed
+    """
+    if opcode in SENTINEL_VALUES:
+        return SENTINEL_VALUES[opcode]
+    if opcode == OP_MSG:
+        return payload
+    if opcode == OP_DATA:
+        return payload if payload else None
+    if opcode in MSG_TUPLE_KINDS:
+        return (MSG_TUPLE_KINDS[opcode], payload)
+    if opcode == OP_BATCH:
+        msgs = []
+        offset = 0
+        while offset < len(payload):
+            if offset + BATCH_LEN.size > len(payload):
+                raise server.MessageError("Truncated batch message length")
+            (length,) = BATCH_LEN.unpack_from(payload, offset)
+            offset += BATCH_LEN.size
+            if offset + length > len(payload):
+                raise server.MessageError("Truncated batch message")
+            msgs.append(payload[offset:offset + length])
+            offset += length
+        return (server.SERVER_BATCH, msgs)
+    if opcode == OP_BATCH_ACK:
+        return (server.SERVER_BATCH_ACK, [bool(status) for status in payload])
+    raise server.MessageError("Unknown opcode %d" % opcode)
+
+
+class WireConnection:
+    """
+    A connection using the binary protocol, with the send(), recv(), poll() and
+    close() methods of a multiprocessing Connection
+    """
+
+    def __init__(self, sock, server_side=False):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server_side = server_side
+
+        self.buffer = bytearray()
+
+        # Clients number their requests, servers reply with the id received
+        self.next_request_id = 1
+        self.last_request_id = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, obj, request_id=None):
+        if request_id is None:
+            request_id = self.next_request_id
+            self.next_request_id = (self.next_request_id + 1) & 0xFFFF
+        (opcode, payload) = encode(obj, self.server_side)
+        self.sock.sendall(FRAME_HDR.pack(opcode, request_id, len(payload)) +
+                          payload)
+        return request_id
+
+    def frame_length(self):
+        """Length of the complete frame at the start of the buffer, or None"""
+        if len(self.buffer) < FRAME_HDR.size:
+            return None
+        (opcode, request_id, length) = FRAME_HDR.unpack_from(self.buffer)
+        if len(self.buffer) < FRAME_HDR.size + length:
+            return None
+        return FRAME_HDR.size + length
+
+    def fill(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise EOFError("Connection closed")
+        self.buffer += data
+
+    def poll(self, timeout=0.0):
+        """Return True if a complete frame can be read within timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.frame_length() is None:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            (readable, _, _) = select.select([self.sock], [], [], remaining)
+            if not readable:
+                return False
+            self.fill()
+        return True
+
+    def recv(self):
+        while self.frame_length() is None:
+            self.fill()
+        length = self.frame_length()
+        (opcode, request_id, _) = FRAME_HDR.unpack_from(self.buffer)
+        payload = bytes(self.buffer[FRAME_HDR.size:length])
+        del self.buffer[:length]
+
+        self.last_request_id = request_id
+        return decode(opcode, payload)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class WireListener:
+    """Accepts binary protocol connections, like a multiprocessing Listener"""
+
+    def __init__(self, address, backlog=16):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(backlog)
+        self.address = self.sock.getsockname()
+        self.last_accepted = None
+
+    def accept(self):
+        (sock, self.last_accepted) = self.sock.accept()
+        return WireConnection(sock, server_side=True)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def connect(address):
+    """Connect to a server using the binary protocol"""
+    return WireConnection(socket.create_connection(address))